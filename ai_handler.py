@@ -13,11 +13,8 @@ from config import *
 from decorators import owner_only
 from helpers import (
     safe_reply,
-    clean_question_format,
-    optimize_for_poll,
-    enforce_correct_answer_format,
+    format_for_telegram,
     nuclear_tick_fix,
-    enforce_telegram_limits_strict
 )
 from gemini_client import call_gemini_api
 
@@ -353,7 +350,7 @@ async def ai_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Call Gemini
     try:
-        raw = call_gemini_api(payload)
+        raw = await call_gemini_api(payload)
         if not raw:
             await safe_reply(update, "❌ Empty AI response.")
             return
@@ -384,10 +381,7 @@ async def ai_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     final_text = assign_ticks_and_build(mcq_structs)
 
     # Final helper cleanups (helpers unchanged)
-    final_text = clean_question_format(final_text)
-    final_text = optimize_for_poll(final_text)
-    final_text = enforce_correct_answer_format(final_text)
-    final_text = enforce_telegram_limits_strict(final_text)
+    final_text = format_for_telegram(final_text, optimize=True)
 
     # If still no ticks (edge-case), force nuclear fix
     if "✅" not in final_text:
@@ -7,7 +7,7 @@ from telegram.constants import ChatAction
 
 from config import *
 from decorators import owner_only
-from helpers import safe_reply, clean_question_format
+from helpers import safe_reply, clean_question_format, count_numbered
 from gemini_client import call_gemini_api
 
 @owner_only
@@ -125,7 +125,7 @@ Ensure ALL questions follow Telegram poll limits:
     }
 
     try:
-        result = call_gemini_api(payload)
+        result = await call_gemini_api(payload)
         
         if not result:
             await safe_reply(update, "❌ **All AI models failed.** Please try again later.")
@@ -147,7 +147,7 @@ Ensure ALL questions follow Telegram poll limits:
         cleaned_result = clean_question_format(clean_text)
         
         # Count questions
-        question_count = len(re.findall(r'\d+\.', cleaned_result))
+        question_count = count_numbered(cleaned_result)
         
         # Create filename
         topic_cleaned = re.sub(r'[^a-zA-Z0-9]', '', topic.replace(" ", "_"))
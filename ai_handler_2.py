@@ -8,7 +8,7 @@ from telegram.constants import ChatAction
 
 from config import *
 from decorators import owner_only
-from helpers import safe_reply, clean_question_format, optimize_for_poll, enforce_correct_answer_format, nuclear_tick_fix, enforce_telegram_limits_strict
+from helpers import safe_reply, clean_question_format, optimize_for_poll, enforce_correct_answer_format, nuclear_tick_fix, enforce_telegram_limits_strict, count_numbered
 from gemini_client import call_gemini_api
 
 logger = logging.getLogger(__name__)
@@ -125,7 +125,7 @@ IF YOU DON'T FOLLOW THESE RULES, THE QUESTIONS WILL BE REJECTED!
     }
 
     try:
-        result = call_gemini_api(payload)
+        result = await call_gemini_api(payload)
         
         if not result:
             await safe_reply(update, "❌ **All AI models failed.** Please try again later.")
@@ -160,7 +160,7 @@ IF YOU DON'T FOLLOW THESE RULES, THE QUESTIONS WILL BE REJECTED!
             final_result = nuclear_tick_fix(final_result)
             logger.warning("⚠️ Used nuclear tick fix - no ticks found in response")
         
-        question_count = len(re.findall(r'\d+\.', final_result))
+        question_count = count_numbered(final_result)
         
         # Create filename
         topic_cleaned = re.sub(r'[^a-zA-Z0-9]', '', topic.replace(" ", "_"))
@@ -11,11 +11,9 @@ from config import *
 from decorators import owner_only
 from helpers import (
     safe_reply,
-    clean_question_format,
-    optimize_for_poll,
-    enforce_correct_answer_format,
+    format_for_telegram,
     nuclear_tick_fix,
-    enforce_telegram_limits_strict
+    count_numbered,
 )
 from gemini_client import call_gemini_api
 
@@ -206,7 +204,7 @@ COUNT: {amount}
     # 3. CALL GEMINI
     # -----------------------------
     try:
-        raw = call_gemini_api(payload)
+        raw = await call_gemini_api(payload)
         if not raw:
             await safe_reply(update, "❌ AI returned empty.")
             return
@@ -249,10 +247,7 @@ COUNT: {amount}
     # -----------------------------
     # 5. HELPER CLEANUPS (unchanged)
     # -----------------------------
-    compact_fixed = clean_question_format(compact_fixed)
-    compact_fixed = optimize_for_poll(compact_fixed)
-    compact_fixed = enforce_correct_answer_format(compact_fixed)
-    compact_fixed = enforce_telegram_limits_strict(compact_fixed)
+    compact_fixed = format_for_telegram(compact_fixed, optimize=True)
 
     # final safety
     if "✅" not in compact_fixed:
@@ -261,7 +256,7 @@ COUNT: {amount}
     # -----------------------------
     # 6. SAVE FILE
     # -----------------------------
-    total = len(re.findall(r'\d+\.', compact_fixed))
+    total = count_numbered(compact_fixed)
 
     with tempfile.NamedTemporaryFile(
         mode="w", delete=False, suffix="_ai_mcqs.txt", encoding="utf-8"
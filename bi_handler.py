@@ -9,9 +9,7 @@ from telegram.ext import ContextTypes
 from config import *
 from decorators import owner_only
 from helpers import (
-    safe_reply, clean_question_format, optimize_for_poll,
-    enforce_correct_answer_format, nuclear_tick_fix,
-    enforce_telegram_limits_strict
+    safe_reply, format_for_telegram, nuclear_tick_fix,
 )
 from gemini_client import call_gemini_api
 
@@ -29,7 +27,7 @@ async def translate(text: str) -> str:
         "generationConfig":{"temperature":0.1,"topK":1,"topP":0.9,"maxOutputTokens":200}
     }
     try:
-        r = await asyncio.to_thread(call_gemini_api, payload, "translation")
+        r = await call_gemini_api(payload, "translation")
         if not r: return text
         r = re.sub(r"```.*?```","",r,flags=re.S).strip()
         return r.split("\n")[0].strip()
@@ -134,10 +132,7 @@ async def bi_command(update:Update, context:ContextTypes.DEFAULT_TYPE):
 
     for i,p in enumerate(parts,1):
         combined="\n\n".join(p)
-        cleaned=clean_question_format(combined)
-        cleaned=optimize_for_poll(cleaned)
-        cleaned=enforce_correct_answer_format(cleaned)
-        cleaned=enforce_telegram_limits_strict(cleaned)
+        cleaned=format_for_telegram(combined, optimize=True)
         if "✅" not in cleaned: cleaned=nuclear_tick_fix(cleaned)
 
         fn=tempfile.NamedTemporaryFile(
@@ -1,18 +1,30 @@
-import os, base64, time, requests, logging, asyncio
-from flask import Flask
-from telegram import Update
+import io, os, zlib, time, json, random, shelve, hashlib, tempfile, requests, logging, asyncio, threading
+try:
+    import pybase64 as base64  # SIMD codec, drop-in for b64encode
+except ImportError:
+    import base64
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from pathlib import Path
+from telegram import Update, InputFile
 from telegram.constants import ParseMode
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
     filters, ContextTypes
 )
-from telegram.error import TimedOut, NetworkError
+from telegram.error import TimedOut, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
 
 # ---------------- CONFIG ----------------
 BOT_TOKEN = os.getenv("BOT_TOKEN") or "YOUR_BOT_TOKEN"
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or "YOUR_GEMINI_API_KEY"
 PORT = int(os.getenv("PORT", 10000))
 MAX_PDF_SIZE_MB = 5
+# Opt-in: gzip-encoded request bodies are not a documented part of the
+# generateContent API, and a 400 there is treated as a model failure.
+GZIP_UPLOAD = os.getenv("GEMINI_GZIP_UPLOAD", "0") == "1"
+LANGUAGES = ("Gujarati", "Hindi", "English")
+QUESTION_COUNT = 20
 
 # Gemini fallback models
 GEMINI_MODELS = [
@@ -23,85 +35,277 @@ GEMINI_MODELS = [
     "gemini-flash-latest"
 ]
 
-# Flask keep-alive
-flask_app = Flask(__name__)
+# Keep-alive: Render's health probe only needs a 200, so a bare asyncio
+# responder on the bot's own event loop replaces the Flask dev server.
+HEALTH_RESPONSE = "HTTP/1.1 200 OK\r\nContent-Type: text/plain; charset=utf-8\r\nContent-Length: {}\r\nConnection: close\r\n\r\n"
+HEALTH_BODY = "✅ OCR Gemini Bot running.".encode("utf-8")
+HEALTH_REPLY = HEALTH_RESPONSE.format(len(HEALTH_BODY)).encode("ascii") + HEALTH_BODY
 
-@flask_app.route("/")
-def home():
-    return "✅ OCR Gemini Bot running."
+async def _health(reader, writer):
+    try:
+        await reader.readline()
+        writer.write(HEALTH_REPLY)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def start_health_server(application):
+    application.bot_data["health_server"] = await asyncio.start_server(_health, "0.0.0.0", PORT)
 
 # Logging setup
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 # ---------------- HELPERS ----------------
-def stream_b64_encode(path: str):
-    with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(57_600), b""):
-            yield base64.b64encode(chunk).decode("utf-8")
-
-def call_gemini_api(data_b64: str, language: str) -> str | None:
-    """Send PDF to Gemini, retry with fallback models."""
-    mime_type = "application/pdf"
-    count = 20
-
-    payload = {
-        "contents": [{
-            "parts": [
-                {"inlineData": {"mimeType": mime_type, "data": data_b64}},
-                {"text": (
-                    f"Extract all text from this PDF and generate exactly {count} "
-                    f"multiple-choice questions in {language}. "
-                    f"Do NOT translate or switch languages. "
-                    f"Each question should follow this structure:\n"
-                    f"1. Question text\n"
-                    f"(a) Option A\n(b) Option B\n(c) Option C\n(d) Option D\n"
-                    f"Mark the correct one with ✅\n"
-                    f"Add an 'Ex:' line explaining the answer in {language}."
-                )}
-            ]
-        }]
-    }
-
-    for model in GEMINI_MODELS:
-        for attempt in range(2):
-            try:
-                url = f"https://generativelanguage.googleapis.com/v1/models/{model}:generateContent?key={GEMINI_API_KEY}"
-                r = requests.post(url, json=payload, timeout=240)
-                if r.status_code == 404:
-                    logging.warning(f"Model not found: {model}")
-                    break
-                r.raise_for_status()
-                data = r.json()
-                text = (
-                    data.get("candidates", [{}])[0]
-                    .get("content", {})
-                    .get("parts", [{}])[0]
-                    .get("text", "")
-                )
-                if text.strip():
-                    logging.info(f"✅ Gemini model used: {model}")
-                    return text
-            except requests.exceptions.Timeout:
-                logging.warning(f"Timeout on {model}, retry {attempt+1}")
-                time.sleep(3)
-            except Exception as e:
-                logging.warning(f"{model} failed: {e}")
-                time.sleep(2)
+PROMPT_TEMPLATE = (
+    "Extract all text from this PDF and generate exactly {count} "
+    "multiple-choice questions in {language}. "
+    "Do NOT translate or switch languages. "
+    "Each question should follow this structure:\n"
+    "1. Question text\n"
+    "(a) Option A\n(b) Option B\n(c) Option C\n(d) Option D\n"
+    "Mark the correct one with ✅\n"
+    "Add an 'Ex:' line explaining the answer in {language}."
+)
+
+# The request body is static apart from the base64 data, so the JSON around it
+# is serialized once per language at import time and spliced in as raw bytes.
+JSON_PREFIX = b'{"contents":[{"parts":[{"inlineData":{"mimeType":"application/pdf","data":"'
+JSON_SUFFIX = {
+    lang: b'"}},' + json.dumps(
+        {"text": PROMPT_TEMPLATE.format(count=QUESTION_COUNT, language=lang)},
+        ensure_ascii=False,
+    ).encode("utf-8") + b']}]}'
+    for lang in LANGUAGES
+}
+
+def build_request_body(data_b64: bytes, language: str) -> bytes:
+    suffix = JSON_SUFFIX.get(language) or JSON_SUFFIX["English"]
+    return b"".join((JSON_PREFIX, data_b64, suffix))
+
+def gzip_body(body: bytes) -> bytes:
+    # Level 1 keeps most of the size win at a fraction of the CPU cost.
+    c = zlib.compressobj(1, zlib.DEFLATED, 31)
+    return c.compress(body) + c.flush()
+
+def encode_pdf(data: bytes, language: str) -> tuple[str, bytes]:
+    """Hash and base64 the in-memory PDF; returns (digest, request body)."""
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    body = build_request_body(base64.b64encode(data), language)
+    return digest, (gzip_body(body) if GZIP_UPLOAD else body)
+
+# Models that answered 404 or kept failing, with the time they were marked bad.
+# They are skipped until BAD_MODEL_TTL seconds have passed.
+BAD_MODEL_TTL = 3600
+BAD_MODEL_FAILURES = 3
+_bad_models: dict[str, float] = {}
+_model_failures: dict[str, int] = {}
+
+def _model_available(model: str) -> bool:
+    return time.time() - _bad_models.get(model, 0) >= BAD_MODEL_TTL
+
+def _record_failure(model: str):
+    _model_failures[model] = _model_failures.get(model, 0) + 1
+    if _model_failures[model] >= BAD_MODEL_FAILURES:
+        logging.warning(f"Skipping {model} for {BAD_MODEL_TTL}s after repeated failures")
+        _bad_models[model] = time.time()
+        _model_failures[model] = 0
+
+def extract_text(raw: bytes) -> str:
+    """Answer text of the first candidate, joining its parts and skipping thought parts."""
+    data = json.loads(raw)
+    try:
+        parts = data["candidates"][0]["content"]["parts"]
+    except (KeyError, IndexError, TypeError):
+        return ""
+    return "".join(p.get("text", "") for p in parts if not p.get("thought"))
+
+# Transient errors (429/5xx) are retried with exponential backoff, honoring
+# Retry-After. 400/404 are returned as-is so model fallback can kick in.
+_retry = Retry(
+    total=4,
+    read=0,
+    backoff_factor=1.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods={"POST"},
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(max_retries=_retry))
+
+def _call_model(model: str, body: bytes) -> str | None:
+    headers = {"Content-Type": "application/json; charset=utf-8"}
+    if GZIP_UPLOAD:
+        headers["Content-Encoding"] = "gzip"
+    url = f"https://generativelanguage.googleapis.com/v1/models/{model}:generateContent?key={GEMINI_API_KEY}"
+    for attempt in range(2):
+        try:
+            r = _session.post(url, data=body, headers=headers, timeout=240)
+            if r.status_code == 404:
+                logging.warning(f"Model not found: {model}")
+                _bad_models[model] = time.time()
+                return None
+            r.raise_for_status()
+            text = extract_text(r.content)
+            if text.strip():
+                logging.info(f"✅ Gemini model used: {model}")
+                _model_failures.pop(model, None)
+                return text
+        except requests.exceptions.Timeout:
+            logging.warning(f"Timeout on {model}, retry {attempt+1}")
+            _record_failure(model)
+            time.sleep(3)
+        except Exception as e:
+            logging.warning(f"{model} failed: {e}")
+            _record_failure(model)
+            time.sleep(2)
     return None
 
-async def safe_reply(update, text, file_path=None):
-    """Safe Telegram reply with retry."""
+async def try_model(model: str, body: bytes) -> str | None:
+    return await asyncio.to_thread(_call_model, model, body)
+
+async def call_gemini_api(body: bytes) -> str | None:
+    """Send PDF to Gemini, trying each available model in order until one answers."""
+    models = [m for m in GEMINI_MODELS if _model_available(m)]
+    if not models:
+        # Everything is marked bad; rather than failing outright, retry them
+        # starting with the model that failed longest ago.
+        models = sorted(GEMINI_MODELS, key=lambda m: _bad_models.get(m, 0))
+
+    # Sequential on purpose: _call_model is a blocking requests call in a worker
+    # thread, and cancelling its task does not stop the thread. A hedged loser
+    # would keep its request (and retries) going for up to 240s, spend quota,
+    # and still count towards _record_failure, which can mark a healthy model
+    # bad. Hedging needs an async client; main_bot's gemini_client has one.
+    for model in models:
+        text = await try_model(model, body)
+        if text:
+            return text
+    return None
+
+SEND_TIMEOUT = 30
+
+async def _send_with_retry(send, what: str) -> bool:
+    """Run send() up to 3 times, honoring flood control and backing off on network errors."""
     for attempt in range(3):
         try:
-            if file_path:
-                await update.message.reply_document(open(file_path, "rb"), caption=text)
-            else:
-                await update.message.reply_text(text)
-            return
-        except (TimedOut, NetworkError) as e:
+            await asyncio.wait_for(send(), timeout=SEND_TIMEOUT)
+            return True
+        except RetryAfter as e:
+            # Telegram says exactly how long the flood block lasts; wait it out.
+            logging.warning(f"Flood control, waiting {e.retry_after}s...")
+            await asyncio.sleep(e.retry_after + 0.5)
+        except (TimedOut, NetworkError, asyncio.TimeoutError) as e:
             logging.warning(f"Telegram send error: {e}, retrying...")
-            await asyncio.sleep(2)
-    logging.error("Failed to send message after retries.")
+            await asyncio.sleep(min(30, 2 ** attempt + random.random()))
+    logging.error(f"Failed to send {what} after retries.")
+    return False
+
+async def safe_reply(update, text, file=None):
+    """Safe Telegram reply with retry. `file` is a path or a named BytesIO."""
+    if file:
+        # InputFile reads the content once; the same upload is reused for every
+        # retry and no file handle stays open during network I/O.
+        if isinstance(file, io.BytesIO):
+            document = InputFile(file.getvalue(), filename=file.name)
+        else:
+            with open(file, "rb") as f:
+                document = InputFile(f, filename=Path(file).name)
+        await _send_with_retry(lambda: update.message.reply_document(document, caption=text), "document")
+        return
+
+    await _send_with_retry(lambda: update.message.reply_text(text), "message")
+
+# ---------------- RESULT CACHE ----------------
+# Generated MCQs keyed by PDF digest + language + question count, so re-running
+# /doneocr on the same PDF skips Gemini. Entries expire after CACHE_TTL; when
+# the cache grows past CACHE_MAX_ENTRIES the oldest ones are dropped.
+CACHE_PATH = os.getenv("OCR_CACHE_PATH", os.path.join(tempfile.gettempdir(), "quickpyq_cache"))
+CACHE_TTL = 7 * 86400
+CACHE_MAX_ENTRIES = 500
+# shelve does not support concurrent access; cache_get/cache_set run in worker
+# threads, so every open of the shelf goes through this lock.
+_cache_lock = threading.Lock()
+
+def cache_key(digest: str, language: str) -> str:
+    return f"{digest}:{language}:{QUESTION_COUNT}"
+
+def cache_get(key: str) -> str | None:
+    try:
+        with _cache_lock, shelve.open(CACHE_PATH) as db:
+            entry = db.get(key)
+    except Exception as e:
+        logging.warning(f"Cache read failed: {e}")
+        return None
+    if entry and time.time() - entry[0] < CACHE_TTL:
+        return entry[1]
+    return None
+
+def cache_set(key: str, text: str):
+    try:
+        with _cache_lock, shelve.open(CACHE_PATH) as db:
+            db[key] = (time.time(), text)
+            if len(db) > CACHE_MAX_ENTRIES:
+                now = time.time()
+                by_age = sorted((db[k][0], k) for k in db.keys())
+                for stamp, k in by_age:
+                    if len(db) <= CACHE_MAX_ENTRIES and now - stamp < CACHE_TTL:
+                        break
+                    del db[k]
+    except Exception as e:
+        logging.warning(f"Cache write failed: {e}")
+
+# Identical requests already in flight (same PDF, language and count) share
+# one Gemini call instead of each starting their own.
+_inflight: dict[str, asyncio.Future] = {}
+
+async def _generate_uncached(key: str, body: bytes) -> str | None:
+    clean_text = await asyncio.to_thread(cache_get, key)
+    if clean_text:
+        logging.info(f"Cache hit for {key}")
+        return clean_text
+    clean_text = await call_gemini_api(body)
+    if clean_text:
+        await asyncio.to_thread(cache_set, key, clean_text)
+    return clean_text
+
+async def generate_mcqs(key: str, body: bytes) -> str | None:
+    fut = _inflight.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(_generate_uncached(key, body))
+        _inflight[key] = fut
+        fut.add_done_callback(lambda f: _inflight.pop(key, None))
+    else:
+        logging.info(f"Joining in-flight request for {key}")
+    # shield: one impatient caller being cancelled must not cancel the others.
+    return await asyncio.shield(fut)
+
+# ---------------- PENDING UPLOADS ----------------
+# PDFs waiting for /doneocr, kept in memory and keyed by (chat, user) so users
+# sharing a group chat do not overwrite each other's upload:
+# (pdf bytes, expiry timestamp). A janitor task drops uploads never processed.
+PDF_TTL = 600
+_pending_pdfs: dict[tuple[int, int], tuple[bytes, float]] = {}
+_janitor_task = None
+
+async def _pdf_janitor():
+    while True:
+        await asyncio.sleep(60)
+        now = time.time()
+        for key, (_, expiry) in list(_pending_pdfs.items()):
+            if expiry < now:
+                _pending_pdfs.pop(key, None)
+                logging.info(f"Removed expired upload for chat {key[0]}, user {key[1]}")
+
+def _pending_key(update: Update) -> tuple[int, int]:
+    return update.effective_chat.id, update.effective_user.id
+
+def _ensure_janitor():
+    global _janitor_task
+    if _janitor_task is None or _janitor_task.done():
+        _janitor_task = asyncio.create_task(_pdf_janitor())
 
 # ---------------- BOT HANDLERS ----------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -115,7 +319,7 @@ async def setlang(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message.text.split()
     if len(msg) == 2:
         lang = msg[1].capitalize()
-        if lang in ["Gujarati", "Hindi", "English"]:
+        if lang in LANGUAGES:
             context.user_data["lang"] = lang
             await safe_reply(update, f"✅ Language set to {lang}.")
             return
@@ -126,7 +330,7 @@ async def ocr(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not lang:
         await safe_reply(update, "⚠️ Please set your language first using /setlang")
         return
-    context.user_data["ocr_pdf"] = None
+    _pending_pdfs.pop(_pending_key(update), None)
     await safe_reply(update, f"📄 OCR started in {lang}.\nSend a single PDF (≤ {MAX_PDF_SIZE_MB} MB), then /doneocr.")
 
 async def collect_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -141,39 +345,40 @@ async def collect_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await safe_reply(update, f"❌ File too large (max {MAX_PDF_SIZE_MB} MB).")
         return
     fobj = await file.get_file()
-    path = await fobj.download_to_drive()
-    context.user_data["ocr_pdf"] = path
+    buf = io.BytesIO()
+    await fobj.download_to_memory(buf)
+
+    _pending_pdfs[_pending_key(update)] = (buf.getvalue(), time.time() + PDF_TTL)
+    _ensure_janitor()
     await safe_reply(update, f"✅ Received: `{file.file_name}`\nNow send /doneocr.",)
 
 async def doneocr(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    pdf_path = context.user_data.get("ocr_pdf")
+    pending = _pending_pdfs.pop(_pending_key(update), None)
     lang = context.user_data.get("lang", "English")
-    if not pdf_path or not os.path.exists(pdf_path):
+    if not pending:
         await safe_reply(update, "⚠️ No PDF uploaded. Use /ocr first.")
         return
+    pdf_data = pending[0]
     await safe_reply(update, f"🧠 Processing PDF in {lang}... Please wait ⏳")
 
     try:
-        data_b64 = "".join(stream_b64_encode(pdf_path))
-        clean_text = call_gemini_api(data_b64, lang)
+        # PDFs are capped at MAX_PDF_SIZE_MB, so encoding takes milliseconds. A
+        # worker thread keeps the event loop free; a process pool would pickle
+        # the PDF in and the larger base64 body back out, and keep one idle
+        # interpreter per core alive for the life of the bot.
+        digest, body = await asyncio.to_thread(encode_pdf, pdf_data, lang)
+        clean_text = await generate_mcqs(cache_key(digest, lang), body)
     except Exception as e:
         await safe_reply(update, f"❌ Error: {e}")
         return
-    finally:
-        try: os.remove(pdf_path)
-        except: pass
-        context.user_data.pop("ocr_pdf", None)
 
     if not clean_text:
         await safe_reply(update, "⚠️ All Gemini models failed or returned empty output.")
         return
 
-    txt_path = f"ocr_questions_{int(time.time())}.txt"
-    with open(txt_path, "w", encoding="utf-8") as f:
-        f.write(clean_text)
-
-    await safe_reply(update, "✅ Generated MCQs", file_path=txt_path)
-    os.remove(txt_path)
+    bio = io.BytesIO(clean_text.encode("utf-8"))
+    bio.name = f"ocr_questions_{int(time.time())}.txt"
+    await safe_reply(update, "✅ Generated MCQs", file=bio)
 
 # Error handler
 def error_handler(update, context):
@@ -181,7 +386,16 @@ def error_handler(update, context):
 
 # ---------------- MAIN ----------------
 def run_bot():
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    # One pooled client for Bot API calls; getUpdates gets its own so long
+    # polling never waits for a connection held by an outgoing send.
+    application = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .request(HTTPXRequest(connection_pool_size=64, connect_timeout=10, read_timeout=60))
+        .get_updates_request(HTTPXRequest(connect_timeout=10, read_timeout=60))
+        .post_init(start_health_server)
+        .build()
+    )
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("setlang", setlang))
     application.add_handler(CommandHandler("ocr", ocr))
@@ -189,9 +403,7 @@ def run_bot():
     application.add_handler(MessageHandler(filters.Document.PDF, collect_pdf))
     application.add_error_handler(error_handler)
 
-    loop = asyncio.get_event_loop()
-    loop.create_task(application.run_polling())
-    flask_app.run(host="0.0.0.0", port=PORT)
+    application.run_polling()
 
 if __name__ == "__main__":
     run_bot()
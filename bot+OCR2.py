@@ -82,6 +82,9 @@ def owner_only(func):
     return wrapper
 
 # ---------------- HELPERS ----------------
+# Any of the a) b) c) d) option markers, found in one scan.
+_RE_ANY_OPT = re.compile(r'[abcd]\)')
+
 def stream_b64_encode(file_path: str) -> str:
     with open(file_path, "rb") as f:
         return base64.b64encode(f.read()).decode("utf-8")
@@ -729,7 +732,7 @@ def clean_question_format(text: str) -> str:
             continue
             
         # Detect if this is a question number line
-        if re.match(r'^\d+\.\s', line) and not any(opt in line for opt in ['a)', 'b)', 'c)', 'd)']):
+        if re.match(r'^\d+\.\s', line) and not _RE_ANY_OPT.search(line):
             # This is a question number line
             if in_question_body and cleaned_lines:
                 # Add blank line before new question
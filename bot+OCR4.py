@@ -79,6 +79,9 @@ def owner_only(func):
     return wrapper
 
 # ---------------- HELPERS ----------------
+# Any of the a) b) c) d) option markers, found in one scan.
+_RE_ANY_OPT = re.compile(r'[abcd]\)')
+
 def stream_b64_encode(file_path: str) -> str:
     with open(file_path, "rb") as f:
         return base64.b64encode(f.read()).decode("utf-8")
@@ -241,7 +244,7 @@ def process_single_question(question_lines):
             if (re.match(r'^\d+\.\s', line) and 
                 not line.startswith(('a)', 'b)', 'c)', 'd)', 'Ex:')) and
                 len(line) > 3 and  # Ensure it's not just "1." or "2."
-                not any(opt in line for opt in ['a)', 'b)', 'c)', 'd)'])):
+                not _RE_ANY_OPT.search(line)):
                 line = re.sub(r'^(\d+)\.\s', r'\1) ', line)
             processed_lines.append(line)
     
@@ -263,7 +266,7 @@ def clean_question_format(text: str) -> str:
             continue
             
         # Check if this line starts a new question
-        if re.match(r'^\d+\.\s', line) and not any(opt in line for opt in ['a)', 'b)', 'c)', 'd)']):
+        if re.match(r'^\d+\.\s', line) and not _RE_ANY_OPT.search(line):
             # Process previous question if exists
             if current_question:
                 cleaned_question = process_single_question(current_question)
@@ -3,11 +3,10 @@ import os
 import io
 import json
 import time
-import base64
 import logging
 import asyncio
-import fitz  # PyMuPDF
 import requests
+from requests.adapters import HTTPAdapter
 from pathlib import Path
 from telegram import Update
 from telegram.ext import (
@@ -65,21 +64,70 @@ def append_output(uid: int, filename: str, text: str):
         f.write(text + "\n\n")
     return out_path
 
-def stream_b64_encode(path: Path):
+# Shared keep-alive pool: the upload and every model/retry in call_gemini
+# reuse one TLS connection to generativelanguage.googleapis.com.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0))
+
+UPLOAD_URL = "https://generativelanguage.googleapis.com/upload/v1beta/files"
+# Gemini deletes uploaded files after 48h; reuse a cached URI only well before that.
+FILE_URI_TTL = 47 * 3600
+
+def upload_to_gemini(path: Path, mime: str) -> str:
+    """Stream the raw file to the Gemini Files API and return its file URI."""
     with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(60_000), b""):
-            yield base64.b64encode(chunk).decode("utf-8")
+        r = _session.post(
+            UPLOAD_URL,
+            params={"key": GEMINI_API_KEY},
+            headers={"X-Goog-Upload-Protocol": "raw", "Content-Type": mime},
+            data=f,
+            timeout=240,
+        )
+    r.raise_for_status()
+    file = r.json()["file"]
+
+    # Large PDFs are briefly PROCESSING; generateContent rejects them until ACTIVE.
+    for _ in range(30):
+        if file.get("state", "ACTIVE") != "PROCESSING":
+            break
+        time.sleep(2)
+        r = _session.get(
+            f"https://generativelanguage.googleapis.com/v1beta/{file['name']}",
+            params={"key": GEMINI_API_KEY},
+            timeout=30,
+        )
+        r.raise_for_status()
+        file = r.json()
+    if file.get("state", "ACTIVE") != "ACTIVE":
+        raise RuntimeError(f"Gemini file {file['name']} is {file['state']}, not ACTIVE")
+    return file["uri"]
+
+def retry_after(r: requests.Response, default: float = 2, cap: float = 60) -> float:
+    """Seconds to wait from a 429's Retry-After header (capped), else default."""
+    try:
+        return min(float(r.headers["Retry-After"]), cap)
+    except (KeyError, ValueError):
+        return default
 
+# Blocking: process_file runs it (and the upload) in a worker thread so the
+# retry sleeps never stall the bot's event loop.
 def call_gemini(payload: dict) -> str | None:
-    headers = {"Content-Type": "application/json"}
+    headers = {"Content-Type": "application/json; charset=utf-8"}
+    # Serialized once; every model and retry posts the same bytes.
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
     for model in GEMINI_MODELS:
-        url = f"https://generativelanguage.googleapis.com/v1/models/{model}:generateContent?key={GEMINI_API_KEY}"
+        url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={GEMINI_API_KEY}"
         for attempt in range(2):
             try:
-                r = requests.post(url, headers=headers, json=payload, timeout=240)
+                r = _session.post(url, headers=headers, data=body, timeout=240)
                 if r.status_code == 404:
                     logging.warning(f"Model not found: {model}")
                     break
+                if r.status_code == 429:
+                    wait = retry_after(r)
+                    logging.warning(f"Rate limited on {model}, waiting {wait}s")
+                    time.sleep(wait)
+                    continue
                 r.raise_for_status()
                 data = r.json()
                 text = data.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
@@ -104,12 +152,15 @@ async def safe_send(update: Update, text: str):
             await asyncio.sleep(2)
 
 async def safe_send_file(update: Update, path: Path, caption=""):
-    for _ in range(3):
-        try:
-            await update.message.reply_document(document=open(path, "rb"), caption=caption)
-            return
-        except (TimedOut, NetworkError):
-            await asyncio.sleep(2)
+    # One handle for all retries, always closed; rewound since PTB reads it to the end.
+    with open(path, "rb") as fh:
+        for _ in range(3):
+            fh.seek(0)
+            try:
+                await update.message.reply_document(document=fh, filename=path.name, caption=caption)
+                return
+            except (TimedOut, NetworkError):
+                await asyncio.sleep(2)
 
 # ---------------- Commands ----------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -161,29 +212,47 @@ async def collect_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["uploads"] = uploads
     await safe_send(update, f"✅ Saved: {path.name}")
 
-def gemini_payload(path: Path, lang: str):
-    mime = "application/pdf" if path.suffix.lower() == ".pdf" else "image/png"
-    data = "".join(stream_b64_encode(path))
+def mime_type(path: Path) -> str:
+    return "application/pdf" if path.suffix.lower() == ".pdf" else "image/png"
+
+PROMPT_TEMPLATE = (
+    "Extract all text and generate maximum high-quality multiple-choice questions in {language}. "
+    "Each question must have options (a)–(d), mark correct with ✅, and add explanation starting with 'Ex:'. "
+    "Focus on competitive exam standard clarity. Output inside a single code block."
+)
+
+def gemini_payload(file_uri: str, mime: str, lang: str):
     return {
         "contents": [{
             "parts": [
-                {"inlineData": {"mimeType": mime, "data": data}},
-                {"text": (
-                    f"Extract all text and generate maximum high-quality multiple-choice questions in {lang}. "
-                    "Each question must have options (a)–(d), mark correct with ✅, and add explanation starting with 'Ex:'. "
-                    "Focus on competitive exam standard clarity. Output inside a single code block."
-                )}
+                {"fileData": {"mimeType": mime, "fileUri": file_uri}},
+                {"text": PROMPT_TEMPLATE.format(language=lang)}
             ]
         }]
     }
 
-async def process_file(update: Update, uid: int, path: Path, lang: str):
+async def process_file(update: Update, uid: int, path: Path, lang: str, file_uris: dict):
     if path.stat().st_size == 0:
         await safe_send(update, f"❌ Error {path.name}: File must be non-empty.")
         return False
 
-    text = call_gemini(gemini_payload(path, lang))
+    mime = mime_type(path)
+    # /resumeocr reuses the file already uploaded by an earlier /doneocr.
+    cached = file_uris.get(str(path))
+    if cached and time.time() - cached[1] < FILE_URI_TTL:
+        file_uri = cached[0]
+    else:
+        try:
+            file_uri = await asyncio.to_thread(upload_to_gemini, path, mime)
+        except Exception as e:
+            logging.warning(f"Gemini upload failed for {path.name}: {e}")
+            await safe_send(update, f"⚠️ Upload to Gemini failed for {path.name}. Use /resumeocr to retry.")
+            return False
+        file_uris[str(path)] = (file_uri, time.time())
+
+    text = await asyncio.to_thread(call_gemini, gemini_payload(file_uri, mime, lang))
     if text:
+        file_uris.pop(str(path), None)
         out_path = append_output(uid, path.name, text)
         await safe_send_file(update, out_path, caption=f"✅ MCQs generated for {path.name}")
         path.unlink(missing_ok=True)
@@ -201,11 +270,12 @@ async def doneocr(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     lang = context.user_data.get("lang", "English")
+    file_uris = context.user_data.setdefault("file_uris", {})
     await safe_send(update, f"🧠 Processing {len(files)} file(s) in {lang}...")
 
     for f in files:
         path = Path(f)
-        await process_file(update, uid, path, lang)
+        await process_file(update, uid, path, lang, file_uris)
 
     await safe_send(update, "✅ All files processed successfully!")
 
@@ -35,12 +35,6 @@ logging.basicConfig(
 )
 
 # ------------------ HELPERS ------------------
-def stream_b64_encode(path: str):
-    """Generator to base64-encode large files in chunks."""
-    with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(57_600), b""):
-            yield base64.b64encode(chunk).decode("utf-8")
-
 def call_gemini_api(data_b64: str) -> str | None:
     """Try multiple Gemini models until one succeeds."""
     mime_type = "application/pdf"
@@ -128,7 +122,8 @@ async def doneocr(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text("🧠 Processing your PDF… Please wait ⏳")
     try:
-        data_b64 = "".join(stream_b64_encode(pdf_path))
+        with open(pdf_path, "rb") as f:
+            data_b64 = base64.b64encode(f.read()).decode("ascii")
         clean_text = call_gemini_api(data_b64)
     except Exception as e:
         await update.message.reply_text(f"❌ Encoding error: {e}")
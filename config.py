@@ -1,5 +1,6 @@
 # config.py
 import os
+import secrets
 
 # Bot Configuration
 BOT_TOKEN = os.getenv("BOT_TOKEN") or "YOUR_BOT_TOKEN"
@@ -7,10 +8,21 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or "YOUR_GEMINI_API_KEY"
 OWNER_USER_ID = int(os.getenv("OWNER_USER_ID", "123456789"))
 PORT = int(os.getenv("PORT", 10000))
 
+# Webhook mode is opt-in: set WEBHOOK_URL (e.g. https://<host>/<BOT_TOKEN>) to
+# receive updates by webhook instead of polling. Either way the Flask app
+# serves the health routes on PORT.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Telegram sends this back in X-Telegram-Bot-Api-Secret-Token on every webhook
+# call; requests without it are rejected. A fresh one is generated per start
+# unless WEBHOOK_SECRET is set.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
 # File Size Limits
 MAX_PDF_SIZE_MB = 15
 MAX_IMAGE_SIZE_MB = 5
 MAX_IMAGES = 10
+# Images sent to Gemini at once by /images; each request already races several models.
+MAX_CONCURRENT_IMAGES = 4
 PROCESSING_TIMEOUT = 300
 
 # Gemini Models
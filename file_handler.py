@@ -1,5 +1,4 @@
 # file_handler.py
-import tempfile
 import logging
 from pathlib import Path
 from telegram import Update
@@ -7,7 +6,7 @@ from telegram.ext import ContextTypes
 
 from config import *
 from decorators import owner_only
-from helpers import safe_reply
+from helpers import safe_reply, download_to_temp
 from image_handler import process_single_image_upload, collect_image, download_image
 
 logger = logging.getLogger(__name__)
@@ -30,11 +29,12 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             await update.message.reply_text("📥 Downloading WebSankul PDF...")
             file_obj = await file.get_file()
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-                pdf_path = tmp_file.name
-            await file_obj.download_to_drive(pdf_path)
+            pdf_path = await download_to_temp(file_obj, ".pdf")
             
             context.user_data["current_file"] = pdf_path
+            # Size from the Telegram metadata, so the handlers never stat the file
+            context.user_data["current_file_size"] = file.file_size
+            context.user_data["current_file_id"] = file.file_unique_id
             context.user_data["awaiting_websankul"] = False
             
             await safe_reply(update,
@@ -55,11 +55,11 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Download file
             await update.message.reply_text("📥 Downloading PDF...")
             file_obj = await file.get_file()
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-                pdf_path = tmp_file.name
-            await file_obj.download_to_drive(pdf_path)
+            pdf_path = await download_to_temp(file_obj, ".pdf")
             
             context.user_data["current_file"] = pdf_path
+            context.user_data["current_file_size"] = file.file_size
+            context.user_data["current_file_id"] = file.file_unique_id
             context.user_data["awaiting_pdf"] = False
             
             await safe_reply(update,
@@ -1,35 +1,187 @@
 # gemini_client.py — Patched with Translation Mode
-import requests
-import time
+import json
+import httpx
+import random
+import asyncio
 import logging
+try:
+    import orjson  # faster serializer for multi-MB base64 payloads
+except ImportError:
+    orjson = None
+try:
+    import h2  # noqa: F401  (enables httpx's HTTP/2 support)
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
 from config import GEMINI_API_KEY, GEMINI_MODELS
 
 logger = logging.getLogger(__name__)
 
+# The API key travels in a header so it never appears in a URL, and therefore
+# never in httpx error messages or tracebacks that get logged.
+JSON_HEADERS = {
+    "Content-Type": "application/json; charset=utf-8",
+    "x-goog-api-key": GEMINI_API_KEY,
+}
+
+# Everything (generateContent, Files API, uploads) stays on one API version:
+# fileData URIs and camelCase request fields are v1beta features.
+API_VERSION_BASE = "https://generativelanguage.googleapis.com/v1beta"
+API_BASE = f"{API_VERSION_BASE}/models"
+TRANSLATION_MODEL = "gemini-2.5-flash-lite"
+TRANSLATION_URL = f"{API_BASE}/{TRANSLATION_MODEL}:generateContent"
+# Built once at import: (model, endpoint) in fallback order.
+_MODEL_URLS = tuple((m, f"{API_BASE}/{m}:generateContent") for m in GEMINI_MODELS)
+
+# One keep-alive pool for every Gemini call, so the model fallback chain and
+# retries reuse the same TLS connection instead of handshaking each time.
+# Async, so a 3-minute OCR call no longer blocks the bot's event loop.
+# With h2 installed the hedged model requests multiplex over one connection.
+_client = httpx.AsyncClient(
+    http2=HTTP2,
+    timeout=httpx.Timeout(connect=10, read=180, write=60, pool=5),
+    # Idle connections are kept for 5 minutes, long enough to span the gap
+    # between /pdf and the /mcq that follows (see warm_connection).
+    limits=httpx.Limits(max_keepalive_connections=8, max_connections=16, keepalive_expiry=300),
+)
+
+async def aclose(*_):
+    """Close the shared client; usable as an Application post_shutdown hook."""
+    await _client.aclose()
+
+async def warm_connection():
+    """
+    Open (or refresh) a pooled connection to the API ahead of the first real
+    request, so DNS and the TLS handshake are done while the user is still
+    sending the file. Any response will do; failures are only logged.
+    """
+    try:
+        await _client.get(f"{FILES_BASE}/models", params={"pageSize": 1}, headers=JSON_HEADERS, timeout=10)
+    except Exception as e:
+        logger.debug(f"Connection warm-up failed: {e}")
+
+def retry_delay(attempt: int, response=None, cap: float = 30) -> float:
+    """
+    Seconds before the next attempt: the server's Retry-After when it sent
+    one, else exponential backoff (2s, 4s, ...) with jitter, both capped.
+    """
+    if response is not None:
+        try:
+            return min(float(response.headers["Retry-After"]), cap)
+        except (KeyError, ValueError):
+            pass
+    return min(2 * 2 ** attempt, cap) * random.uniform(0.5, 1.0)
+
+
+# Stands in for base64 bytes during serialization; never occurs in prompt text.
+_B64_SLOT = "__inline_b64__"
+_B64_SLOT_JSON = f'"{_B64_SLOT}"'.encode()
+
+def encode_payload(payload) -> bytes:
+    """
+    Serialize a request payload once, as UTF-8.
+    ensure_ascii=False keeps Gujarati/Hindi text and ✅ as raw UTF-8
+    instead of expanding every character to a \\uXXXX escape.
+    Uses orjson when installed (same UTF-8 output, several times faster).
+
+    inlineData may carry the base64 as bytes (see helpers.stream_b64_encode).
+    Base64 needs no JSON escaping, so those bytes are spliced into the body
+    in place of a placeholder instead of being serialized as a str.
+    """
+    blobs = []
+
+    def _slot(obj):
+        if isinstance(obj, (bytes, bytearray)):
+            blobs.append(obj)
+            return _B64_SLOT
+        raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+    if orjson is not None:
+        body = orjson.dumps(payload, default=_slot)
+    else:
+        body = json.dumps(payload, ensure_ascii=False, default=_slot).encode("utf-8")
+    if not blobs:
+        return body
+
+    pieces = body.split(_B64_SLOT_JSON)
+    out = [pieces[0]]
+    for blob, piece in zip(blobs, pieces[1:]):
+        out += (b'"', blob, b'"', piece)
+    return b"".join(out)
+
+def extract_text(raw: bytes) -> str:
+    """First candidate's text from a generateContent response, or "" if absent."""
+    data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    try:
+        return data["candidates"][0]["content"]["parts"][0]["text"]
+    except (KeyError, IndexError, TypeError):
+        return ""
+
+# -------------------------------
+# FILES API: upload once, reference by URI
+# -------------------------------
+FILES_BASE = API_VERSION_BASE
+UPLOAD_URL = "https://generativelanguage.googleapis.com/upload/v1beta/files"
+UPLOAD_CHUNK = 1 << 20
+
+async def _read_chunks(path):
+    # Disk reads in worker threads; at most one chunk is held in memory.
+    with open(path, "rb") as f:
+        while chunk := await asyncio.to_thread(f.read, UPLOAD_CHUNK):
+            yield chunk
+
+async def upload_file(path: str, mime: str, size: int) -> dict:
+    """
+    Stream the raw file to the Gemini Files API and return its file resource
+    ("name", "uri", ...). Raw bytes: no base64, no JSON body.
+    """
+    headers = {
+        "X-Goog-Upload-Protocol": "raw",
+        "Content-Type": mime,
+        "Content-Length": str(size),
+        "x-goog-api-key": GEMINI_API_KEY,
+    }
+    response = await _client.post(UPLOAD_URL, content=_read_chunks(path), headers=headers, timeout=240)
+    response.raise_for_status()
+    file = response.json()["file"]
+
+    # Large PDFs are briefly PROCESSING; generateContent rejects them until ACTIVE.
+    for _ in range(30):
+        if file.get("state", "ACTIVE") != "PROCESSING":
+            break
+        await asyncio.sleep(2)
+        response = await _client.get(f"{FILES_BASE}/{file['name']}", headers=JSON_HEADERS)
+        response.raise_for_status()
+        file = response.json()
+    if file.get("state", "ACTIVE") != "ACTIVE":
+        # Still PROCESSING or FAILED: unusable, so callers fall back to inline data.
+        await delete_file(file["name"])
+        raise RuntimeError(f"Gemini file {file['name']} is {file['state']}, not ACTIVE")
+    return file
+
+async def delete_file(name: str):
+    """Remove an uploaded file; failures are only logged (Gemini expires files after 48h)."""
+    try:
+        response = await _client.delete(f"{FILES_BASE}/{name}", headers=JSON_HEADERS)
+        response.raise_for_status()
+    except Exception as e:
+        logger.warning(f"⚠️ Could not delete uploaded file {name}: {e}")
+
+
 # -------------------------------
 # TRANSLATION MODE: single-model, no fallback
 # -------------------------------
-def call_gemini_translation(payload):
+async def call_gemini_translation(payload):
     """
     Lightweight mode for /bi translations.
     Uses ONLY one model to avoid rate limit overload.
     """
-    model = "gemini-2.5-flash-lite"
-
     try:
-        logger.info(f"🌐 Translation mode → {model}")
-        url = f"https://generativelanguage.googleapis.com/v1/models/{model}:generateContent?key={GEMINI_API_KEY}"
-        response = requests.post(url, json=payload, timeout=40)
+        logger.info(f"🌐 Translation mode → {TRANSLATION_MODEL}")
+        response = await _client.post(TRANSLATION_URL, content=encode_payload(payload), headers=JSON_HEADERS, timeout=40)
 
         response.raise_for_status()
-        data = response.json()
-
-        text = (
-            data.get("candidates", [{}])[0]
-            .get("content", {})
-            .get("parts", [{}])[0]
-            .get("text", "")
-        )
+        text = extract_text(response.content)
 
         return text.strip()
 
@@ -42,50 +194,97 @@ def call_gemini_translation(payload):
 # -------------------------------
 # DEFAULT MODE: full fallback & retries (OCR/AI)
 # -------------------------------
-def call_gemini_default(payload):
+# The preferred model gets HEDGE_DELAY seconds on its own; if it has not
+# answered by then the next model is started alongside it and the first
+# non-empty answer wins. Only the top HEDGED_MODELS are ever raced, the rest
+# are tried one by one if none of those returned text.
+HEDGED_MODELS = 2
+HEDGE_DELAY = 20
+# Attempts per model before moving on to the next one.
+MODEL_ATTEMPTS = 3
+
+
+async def _try_model(model, url, body):
+    """Up to MODEL_ATTEMPTS attempts on one model. Returns text, or None on failure/404."""
+    logger.info(f"🔄 Trying model: {model}")
+
+    for attempt in range(MODEL_ATTEMPTS):
+        last = attempt == MODEL_ATTEMPTS - 1
+        try:
+            response = await _client.post(url, content=body, headers=JSON_HEADERS)
+
+            # Model removed? Skip
+            if response.status_code == 404:
+                logger.warning(f"❌ Model not available: {model}")
+                return None
+
+            # Rate limited / overloaded: back off and retry the same model
+            if response.status_code == 429 or response.status_code >= 500:
+                logger.warning(f"⏳ {model} returned {response.status_code}, attempt {attempt+1}")
+                if not last:
+                    await asyncio.sleep(retry_delay(attempt, response))
+                continue
+
+            response.raise_for_status()
+            text = extract_text(response.content)
+
+            if text.strip():
+                ok = any(tag in text for tag in ["1.", "Q1", "Question", "(A)", "(B)"])
+                if ok:
+                    logger.info(f"✅ Success with {model}")
+                else:
+                    logger.warning(f"⚠️ {model} returned text (format unclear)")
+                return text
+
+        except httpx.TimeoutException:
+            logger.warning(f"⏰ Timeout on {model}, attempt {attempt+1}")
+            if not last:
+                await asyncio.sleep(retry_delay(attempt))
+
+        except Exception as e:
+            logger.error(f"❌ Model {model} failed: {e}")
+            if not last:
+                await asyncio.sleep(retry_delay(attempt))
+
+    return None
+
+
+async def call_gemini_default(payload):
     """
     Heavy-duty mode for OCR & MCQ generation.
-    Uses fallback chain from GEMINI_MODELS.
+    Starts the preferred model and hedges with the next one if it is slow;
+    first non-empty answer wins, then falls back through the remaining
+    models sequentially.
     """
-    for model in GEMINI_MODELS:
-        logger.info(f"🔄 Trying model: {model}")
-
-        for attempt in range(2):
-            try:
-                url = f"https://generativelanguage.googleapis.com/v1/models/{model}:generateContent?key={GEMINI_API_KEY}"
-                response = requests.post(url, json=payload, timeout=180)
-
-                # Model removed? Skip
-                if response.status_code == 404:
-                    logger.warning(f"❌ Model not available: {model}")
-                    break
-
-                response.raise_for_status()
-                data = response.json()
-
-                text = (
-                    data.get("candidates", [{}])[0]
-                    .get("content", {})
-                    .get("parts", [{}])[0]
-                    .get("text", "")
-                )
-
-                if text.strip():
-                    ok = any(tag in text for tag in ["1.", "Q1", "Question", "(A)", "(B)"])
-                    if ok:
-                        logger.info(f"✅ Success with {model}")
-                        return text
-                    else:
-                        logger.warning(f"⚠️ {model} returned text (format unclear)")
-                        return text
-
-            except requests.exceptions.Timeout:
-                logger.warning(f"⏰ Timeout on {model}, attempt {attempt+1}")
-                time.sleep(2)
-
-            except Exception as e:
-                logger.error(f"❌ Model {model} failed: {e}")
-                time.sleep(2)
+    # Encoded once and reused for every model and retry below.
+    body = encode_payload(payload)
+
+    hedged = list(_MODEL_URLS[:HEDGED_MODELS])
+    model, url = hedged.pop(0)
+    pending = {asyncio.create_task(_try_model(model, url, body))}
+    try:
+        while pending:
+            # Wait for an answer, but only HEDGE_DELAY while a hedge is still left.
+            timeout = HEDGE_DELAY if hedged else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                text = task.result()
+                if text:
+                    return text
+            # Slow or failed: bring in the next model.
+            if hedged:
+                model, url = hedged.pop(0)
+                pending.add(asyncio.create_task(_try_model(model, url, body)))
+    finally:
+        # Losing requests are cancelled and their connections released, also
+        # when the caller itself is cancelled while waiting.
+        for t in pending:
+            t.cancel()
+
+    for model, url in _MODEL_URLS[HEDGED_MODELS:]:
+        text = await _try_model(model, url, body)
+        if text:
+            return text
 
     return None
 
@@ -94,12 +293,12 @@ def call_gemini_default(payload):
 # -------------------------------
 # UNIVERSAL ENTRY FUNCTION
 # -------------------------------
-def call_gemini_api(payload, mode="default"):
+async def call_gemini_api(payload, mode="default"):
     """
     mode="default" → OCR, AI, PDF, content
     mode="translation" → /bi (safe, single-model)
     """
     if mode == "translation":
-        return call_gemini_translation(payload)
+        return await call_gemini_translation(payload)
 
-    return call_gemini_default(payload)
+    return await call_gemini_default(payload)
@@ -1,38 +1,274 @@
 # helpers.py
 import os
-import base64
+import time
+import zlib
+import shelve
+import hashlib
+import binascii
 import re
+import bisect
+import functools
+import itertools
 import tempfile
 import logging
+import asyncio
+import threading
+import httpx
+try:
+    import pybase64  # SIMD base64 codec for multi-MB image/PDF uploads
+except ImportError:
+    pybase64 = None
 from pathlib import Path
-from telegram import Update, InputFile
+from typing import Final, Iterable, Optional
+from telegram import File, Update
 from telegram.constants import ParseMode
 
 logger = logging.getLogger(__name__)
 
-def stream_b64_encode(file_path: str) -> str:
+# The module is fully annotated so it can be compiled with mypyc
+# (`mypyc helpers.py`); the resulting extension shadows this file on import,
+# and without it the pure-Python module is used unchanged.
+
+# Patterns used inside the per-line cleanup loops, compiled once.
+_RE_NUM_DOT_SP: Final = re.compile(r'^\d+\.\s')
+_RE_ROMAN: Final = re.compile(r'^[IIVX]+\.')
+_RE_OPT_D: Final = re.compile(r'^\(D\)')
+_RE_EXPLAIN_PREFIX: Final = re.compile(r'^(?:વિગતઃ|Explanation:|Explain:|Details:)')
+_RE_ANY_OPT: Final = re.compile(r'\([A-D]\)')
+
+# Codepoint deletion tables for str.translate. The strings keep the U+FE0F
+# variation selectors (✔️, ☑️, 🖼️), so those are stripped as well.
+_TICK_TABLE: Final = dict.fromkeys(map(ord, '✅✓✔️☑️🔴🟢⭐🎯'))
+_TICK_TABLE_BASIC: Final = dict.fromkeys(map(ord, '✅✓✔️☑️'))
+_ICON_TABLE: Final = dict.fromkeys(map(ord, '🔍📝🔑💡🎯🔄📄🖼️🌍📊'))
+# Maps '!' and '?' to '.', so one str.split('.') splits sentences like re.split(r'[.!?]').
+_SENT_NORM: Final = str.maketrans({'!': '.', '?': '.'})
+
+def _is_qnum(line: str) -> bool:
+    """Line starts with digits then a dot ("12."). isdecimal() matches what regex \\d does."""
+    i = 0
+    n = len(line)
+    while i < n and line[i].isdecimal():
+        i += 1
+    return 0 < i < n and line[i] == '.'
+
+def _is_option(line: str) -> bool:
+    """Line starts with an option marker: (A), (B), (C) or (D)."""
+    return len(line) >= 3 and line[0] == '(' and line[2] == ')' and line[1] in 'ABCD'
+
+def _line_kind(line: str) -> Optional[str]:
+    """
+    Classify a line once: 'q' (question number), 'opt' ((A)-(D) option),
+    'ex' (Ex: explanation) or None. The three prefixes start with different
+    characters, so the first character picks the only test worth running.
+    """
+    first = line[:1]
+    if first.isdecimal():
+        return 'q' if _is_qnum(line) else None
+    if first == '(':
+        return 'opt' if _is_option(line) else None
+    if first == 'E':
+        return 'ex' if line.startswith('Ex:') else None
+    return None
+
+def count_numbered(text: str) -> int:
+    """
+    Number of "N." markers, same as len(re.findall(r'\d+\.', text)): every '.'
+    straight after a digit ends exactly one such match. Split + isdecimal
+    runs in C without the regex engine or a list of match strings.
+    """
+    return sum(1 for piece in text.split('.')[:-1] if piece[-1:].isdecimal())
+
+# Multiple of 3 so every chunk encodes without padding and the pieces concatenate.
+B64_CHUNK: Final = 3 * 64 * 1024
+
+# pybase64 when installed (same output, AVX2/NEON kernels), else stdlib binascii.
+_b64_chunk: Final = (pybase64.b64encode if pybase64 is not None
+                     else functools.partial(binascii.b2a_base64, newline=False))
+
+def stream_b64_encode(file_path: str) -> bytearray:
+    # Encode chunk by chunk so the raw file is never held in memory whole.
+    # Buffered read(n) always returns n bytes until EOF, keeping chunks aligned.
+    # The ASCII bytes are returned as-is: gemini_client splices them straight
+    # into the request body, so they are never decoded to str or JSON-escaped.
+    buf = bytearray()
     with open(file_path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+        while chunk := f.read(B64_CHUNK):
+            buf += _b64_chunk(chunk)
+    return buf
+
+async def stream_b64_encode_async(file_path: str) -> bytearray:
+    return await asyncio.to_thread(stream_b64_encode, file_path)
+
+# Telegram file downloads: streamed, so a 15MB PDF is never buffered whole.
+DOWNLOAD_CHUNK: Final = 1 << 20
+_download_client: Final = httpx.AsyncClient(timeout=httpx.Timeout(connect=10, read=60, write=60, pool=5))
+
+async def download_to_temp(file: File, suffix: str) -> str:
+    """
+    Stream a telegram.File into a new temp file and return its path. PTB's
+    download_to_drive reads the whole body into memory before writing it.
+    """
+    if file.file_path is None:
+        raise RuntimeError("Telegram file has no download path")
+    url = file.file_path
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async with _download_client.stream("GET", url) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK):
+                    await asyncio.to_thread(f.write, chunk)
+    except httpx.HTTPError as e:
+        os.unlink(path)
+        # file_path embeds the bot token, and httpx puts the URL in its error
+        # messages, which callers log and echo to the chat. Re-raised without it.
+        status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else type(e).__name__
+        raise RuntimeError(f"Telegram file download failed ({status})") from None
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path
+
+async def close_download_client(*_: object) -> None:
+    """Close the download client; called from the Application's post_shutdown."""
+    await _download_client.aclose()
+
+async def remove_files(*paths: str) -> None:
+    """Delete input temp files in worker threads, concurrently; failures are logged."""
+    results = await asyncio.gather(*(asyncio.to_thread(os.unlink, p) for p in paths), return_exceptions=True)
+    for path, result in zip(paths, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error cleaning {path}: {result}")
+
+# ---------------- RESPONSE CACHE ----------------
+# Cleaned Gemini output keyed by PDF identity + mode + language, so the same exam
+# PDF uploaded again (shared WebSankul papers) skips the multi-minute call.
+# A PDF is identified by Telegram's file_unique_id and by its content digest.
+# Entries are (timestamp, zlib-compressed UTF-8 text), unlike bot+OCR1.py's
+# plain-str entries; they expire after RESPONSE_CACHE_TTL, and once there are
+# more than RESPONSE_CACHE_MAX_ENTRIES the oldest ones are dropped.
+RESPONSE_CACHE_PATH: Final = os.getenv("RESPONSE_CACHE_PATH", os.path.join(tempfile.gettempdir(), "quickpyq_responses"))
+RESPONSE_CACHE_TTL: Final = 30 * 86400
+RESPONSE_CACHE_MAX_ENTRIES: Final = 500
+# A sweep unpickles every entry, so it runs at most once per RESPONSE_CACHE_SWEEP
+# seconds, or when a write takes the cache over RESPONSE_CACHE_MAX_ENTRIES.
+# It trims to 90% of the limit so the next writes do not sweep again at once.
+RESPONSE_CACHE_SWEEP: Final = 3600
+_last_sweep: float = 0.0
+# dbm handles are not safe to open from several worker threads at once.
+_cache_lock: Final = threading.Lock()
+DIGEST_CHUNK: Final = 1 << 20
+# Texts are stored deflated: the repeated option/Ex: scaffolding shrinks them to
+# about a quarter, and level 6 decompresses far faster than the shelve read.
+RESPONSE_CACHE_LEVEL: Final = 6
+
+def file_digest(file_path: str) -> str:
+    # Hashed 1 MiB at a time so peak memory stays one buffer whatever the PDF size.
+    h = hashlib.blake2b(digest_size=16)
+    buf = bytearray(DIGEST_CHUNK)
+    view = memoryview(buf)
+    with open(file_path, "rb", buffering=0) as f:
+        while n := f.readinto(buf):
+            h.update(view[:n])
+    return h.hexdigest()
+
+def cache_get(key: str) -> Optional[str]:
+    try:
+        with _cache_lock, shelve.open(RESPONSE_CACHE_PATH) as db:
+            entry = db.get(key)
+        if entry and time.time() - entry[0] < RESPONSE_CACHE_TTL:
+            return zlib.decompress(entry[1]).decode("utf-8")
+    except Exception as e:
+        logger.warning(f"Cache read failed: {e}")
+    return None
+
+def _sweep_cache(db: "shelve.Shelf[tuple[float, bytes]]", now: float) -> None:
+    """Drop expired entries, then the oldest ones down to 90% of the limit."""
+    by_age = sorted((db[k][0], k) for k in db.keys())
+    excess = len(by_age) - RESPONSE_CACHE_MAX_ENTRIES * 9 // 10
+    for i, (stamp, k) in enumerate(by_age):
+        if i >= excess and now - stamp < RESPONSE_CACHE_TTL:
+            break
+        del db[k]
+
+def cache_set(keys: Iterable[str], text: str) -> None:
+    global _last_sweep
+    try:
+        with _cache_lock, shelve.open(RESPONSE_CACHE_PATH) as db:
+            now = time.time()
+            entry = (now, zlib.compress(text.encode("utf-8"), RESPONSE_CACHE_LEVEL))
+            for key in keys:
+                db[key] = entry
+            if now - _last_sweep >= RESPONSE_CACHE_SWEEP or len(db) > RESPONSE_CACHE_MAX_ENTRIES:
+                _sweep_cache(db, now)
+                _last_sweep = now
+    except Exception as e:
+        logger.warning(f"Cache write failed: {e}")
+
+async def cache_get_async(key: str) -> Optional[str]:
+    return await asyncio.to_thread(cache_get, key)
+
+async def cache_set_async(keys: Iterable[str], text: str) -> None:
+    await asyncio.to_thread(cache_set, keys, text)
+
+async def pdf_cache_lookup(file_path: str, file_id: Optional[str], mode: str, lang: str) -> tuple[Optional[str], list[str]]:
+    """
+    The cached result for a PDF, or None plus the keys to store a fresh one
+    under. The file_unique_id stays the same whenever a file is forwarded or
+    re-sent, so it is tried first and costs no disk read; the content digest
+    still catches the same PDF uploaded as a new file.
+    """
+    keys: list[str] = []
+    if file_id:
+        keys.append(f"tg:{file_id}:{mode}:{lang}")
+        text = await cache_get_async(keys[0])
+        if text is not None:
+            return text, []
+    keys.append(f"{await asyncio.to_thread(file_digest, file_path)}:{mode}:{lang}")
+    text = await cache_get_async(keys[-1])
+    if text is None:
+        return None, keys
+    if file_id:
+        # The next forward of this file then hits without hashing it
+        await cache_set_async(keys[:1], text)
+    return text, []
+
+_MIME_MAP: Final = {
+    '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png',
+    '.webp': 'image/webp', '.bmp': 'image/bmp', '.tiff': 'image/tiff',
+    '.tif': 'image/tiff', '.heic': 'image/heic', '.heif': 'image/heif'
+}
+
+@functools.lru_cache(maxsize=64)
+def _mime_from_ext(ext: str) -> str:
+    return _MIME_MAP.get(ext.lower(), 'image/jpeg')
 
 def get_mime_type(file_path: str) -> str:
-    ext = Path(file_path).suffix.lower()
-    mime_map = {
-        '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png',
-        '.webp': 'image/webp', '.bmp': 'image/bmp', '.tiff': 'image/tiff',
-        '.tif': 'image/tiff', '.heic': 'image/heic', '.heif': 'image/heif'
-    }
-    return mime_map.get(ext, 'image/jpeg')
-
-async def safe_reply(update: Update, text: str, file_path: str = None):
+    # Same suffix rule as Path(file_path).suffix, without building a Path.
+    name = file_path.rpartition('/')[2]
+    dot = name.rfind('.')
+    return _mime_from_ext(name[dot:] if 0 < dot < len(name) - 1 else '')
+
+async def _reply_document(update: Update, data: bytes, filename: str, text: str) -> None:
+    await update.message.reply_document(
+        document=data,
+        filename=filename,
+        caption=text[:1000] if text else "Generated questions",
+        read_timeout=60,
+        write_timeout=300
+    )
+
+async def safe_reply(update: Update, text: str, file_path: Optional[str] = None) -> bool:
     try:
         if file_path and os.path.exists(file_path):
-            with open(file_path, "rb") as file:
-                await update.message.reply_document(
-                    document=InputFile(file, filename=Path(file_path).name),
-                    caption=text[:1000] if text else "Generated questions"
-                )
+            # Disk reads and the unlink run in a worker thread, off the event loop.
+            # PTB buffers any file object fully for the multipart upload, so the
+            # bytes are handed over as-is rather than re-read from a BytesIO.
+            data = await asyncio.to_thread(Path(file_path).read_bytes)
+            await _reply_document(update, data, Path(file_path).name, text)
             try:
-                os.unlink(file_path)
+                await asyncio.to_thread(os.unlink, file_path)
             except Exception as e:
                 logger.error(f"Error cleaning output file: {e}")
         else:
@@ -42,273 +278,265 @@ async def safe_reply(update: Update, text: str, file_path: str = None):
         logger.error(f"Send error: {e}")
         return False
 
-def optimize_for_poll(text: str) -> str:
-    lines = text.split('\n')
-    optimized_lines = []
-    
-    for line in lines:
-        if not line.strip():
-            optimized_lines.append(line)
-            continue
+async def reply_text_file(update: Update, text: str, content: str, filename: str) -> bool:
+    """
+    Send generated text as a UTF-8 .txt document straight from memory. The
+    upload only needs the bytes, so no temp file is created, read back and
+    unlinked for it.
+    """
+    try:
+        await _reply_document(update, content.encode("utf-8"), filename, text)
+        return True
+    except Exception as e:
+        logger.error(f"Send error: {e}")
+        return False
+
+def _fitting_prefix(items: list[str], limit: int) -> int:
+    """
+    How many leading items fit in limit when each costs its length plus one
+    (the separator or period that follows it).
+    """
+    return bisect.bisect_right(list(itertools.accumulate(len(x) + 1 for x in items)), limit)
+
+def _truncate_words(text: str, limit: int) -> str:
+    """
+    Leading whole words whose lengths (+1 each) fit in limit, or a hard cut
+    at limit when even the first word does not fit.
+    """
+    words = text.split()
+    k = _fitting_prefix(words, limit)
+    return ' '.join(words[:k]) if k else text[:limit]
+
+@functools.lru_cache(maxsize=2048)
+def _leading_sentences(explanation: str, limit: int) -> str:
+    """
+    Leading sentences of explanation that fit in limit, joined with '. ';
+    "" when not even the first fits. Cached because the optimise and limit
+    stages run over the same explanations back to back. The split removes
+    every '.', so each sentence is counted with one added period.
+    """
+    sentences = [p for p in map(str.strip, explanation.translate(_SENT_NORM).split('.')) if p]
+    return '. '.join(sentences[:_fitting_prefix(sentences, limit)])
+
+def _optimize_line(line: str) -> str:
+    # Nothing up to 104 chars is shortened (the tightest limit is 100 chars
+    # of option text after the 4-char marker), so skip classifying it.
+    if len(line) <= 104 or not line.strip():
+        return line
+        
+    kind = _line_kind(line)
+    if kind == 'q':
+        if len(line) > 4000:
+            return _truncate_words(line, 4000)
+        return line
             
-        if re.match(r'^\d+\.', line):
-            if len(line) > 4000:
-                words = line.split()
-                shortened = []
-                current_length = 0
-                for word in words:
-                    if current_length + len(word) + 1 <= 4000:
-                        shortened.append(word)
-                        current_length += len(word) + 1
-                    else:
-                        break
-                optimized_lines.append(' '.join(shortened) if shortened else line[:4000])
-            else:
-                optimized_lines.append(line)
-                
-        elif line.startswith('Ex:'):
-            explanation = line[3:].strip()
-            if len(explanation) > 200:
-                sentences = re.split(r'[.!?]', explanation)
-                important_parts = []
-                current_length = 0
-                for sentence in sentences:
-                    sentence = sentence.strip()
-                    if not sentence:
-                        continue
-                    sentence_with_dot = sentence + '.' if not sentence.endswith('.') else sentence
-                    if current_length + len(sentence_with_dot) <= 200:
-                        important_parts.append(sentence)
-                        current_length += len(sentence_with_dot)
-                    else:
-                        break
-                if important_parts:
-                    optimized_explanation = '. '.join(important_parts)
-                    if not optimized_explanation.endswith(('.', '!', '?')):
-                        optimized_explanation += '.'
-                    optimized_lines.append(f"Ex: {optimized_explanation}")
-                else:
-                    optimized_lines.append(f"Ex: {explanation[:200]}")
-            else:
-                optimized_lines.append(line)
-                
-        elif re.match(r'^\([A-D]\)', line):
-            option_text = line[4:].strip()
-            if len(option_text) > 100:
-                words = option_text.split()
-                shortened = []
-                current_length = 0
-                for word in words:
-                    if current_length + len(word) + 1 <= 100:
-                        shortened.append(word)
-                        current_length += len(word) + 1
-                    else:
-                        break
-                optimized_lines.append(f"{line[:4]}{' '.join(shortened)}" if shortened else f"{line[:4]}{option_text[:100]}")
-            else:
-                optimized_lines.append(line)
-                
-        else:
-            optimized_lines.append(line)
-    
-    return '\n'.join(optimized_lines)
+    if kind == 'ex':
+        explanation = line[3:].strip()
+        if len(explanation) > 200:
+            optimized_explanation = _leading_sentences(explanation, 200)
+            if optimized_explanation:
+                if not optimized_explanation.endswith(('.', '!', '?')):
+                    optimized_explanation += '.'
+                return f"Ex: {optimized_explanation}"
+            return f"Ex: {explanation[:200]}"
+        return line
+            
+    if kind == 'opt':
+        option_text = line[4:].strip()
+        if len(option_text) > 100:
+            return f"{line[:4]}{_truncate_words(option_text, 100)}"
+        return line
+            
+    return line
 
-def process_single_question(question_lines):
-    processed_lines = []
+def optimize_for_poll(text: str) -> str:
+    return '\n'.join(_format_lines(text.split('\n'), optimize=True))
+
+def process_single_question(question_lines: list[str]) -> list[str]:
+    processed_lines: list[str] = []
     for i, line in enumerate(question_lines):
-        if i == 0 and re.match(r'^\d+\.\s', line):
+        # Only lines starting with a digit can be "N. "; skip the regex otherwise,
+        # which also makes re-running on already converted "N) " lines cheap.
+        numbered = line[:1].isdecimal() and _RE_NUM_DOT_SP.match(line)
+        if i == 0 and numbered:
             processed_lines.append(line)
         else:
-            if (re.match(r'^\d+\.\s', line) and 
+            if (numbered and 
                 not line.startswith(('(A)', '(B)', '(C)', '(D)', 'Ex:')) and
                 len(line) > 3):
-                line = re.sub(r'^(\d+)\.\s', r'\1) ', line)
+                # "N.<space>" -> "N) ": the first '.' ends the number, and the
+                # whitespace after it becomes a plain space.
+                dot = line.index('.')
+                line = line[:dot] + ') ' + line[dot + 2:]
             processed_lines.append(line)
     return processed_lines
 
-def clean_question_format(text: str) -> str:
-    text = re.sub(r'[🔍📝🔑💡🎯🔄📄🖼️🌍📊]', '', text)
+def _flush_question(question: list[str], out: list[str]) -> None:
+    out.extend(_format_lines(process_single_question(question), optimize=True))
+
+def _clean_question_lines(text: str) -> list[str]:
+    """
+    Single scan that groups lines into question blocks. Whether the open
+    block holds a statement line (I. II. III.) is tracked as lines are
+    added, instead of re-scanning the block at every blank line.
+    """
+    text = text.translate(_ICON_TABLE)
     lines = text.split('\n')
-    cleaned_lines = []
-    current_question = []
+    cleaned_lines: list[str] = []
+    current_question: list[str] = []
+    has_statements = False
     
     for line in lines:
         line = line.strip()
         if not line:
             # Add blank line only between questions, not within questions
-            if current_question and not any(re.match(r'^[IIVX]+\.', l) for l in current_question):
+            if current_question and not has_statements:
                 cleaned_lines.append(line)
             continue
             
         # Check if this line starts a new question
-        if re.match(r'^\d+\.\s', line) and not any(opt in line for opt in ['(A)', '(B)', '(C)', '(D)']):
+        if _RE_NUM_DOT_SP.match(line) and not _RE_ANY_OPT.search(line):
             # Process previous question if exists
             if current_question:
-                cleaned_question = process_single_question(current_question)
-                optimized_question = optimize_for_poll('\n'.join(cleaned_question))
-                cleaned_lines.extend(optimized_question.split('\n'))
+                _flush_question(current_question, cleaned_lines)
                 # Add ONE blank line between questions
                 cleaned_lines.append('')
-                current_question = []
             
-            current_question.append(line)
+            # A question line starts with a digit, so it is never a statement
+            current_question = [line]
+            has_statements = False
         elif current_question:
             # Keep statements (I. II. III.) within the same question
-            if re.match(r'^[IIVX]+\.', line):
-                current_question.append(line)
-            else:
-                current_question.append(line)
+            current_question.append(line)
+            if not has_statements and _RE_ROMAN.match(line):
+                has_statements = True
         else:
             cleaned_lines.append(line)
     
     # Process the last question
     if current_question:
-        cleaned_question = process_single_question(current_question)
-        optimized_question = optimize_for_poll('\n'.join(cleaned_question))
-        cleaned_lines.extend(optimized_question.split('\n'))
+        _flush_question(current_question, cleaned_lines)
     
     # Remove trailing blank lines
     while cleaned_lines and cleaned_lines[-1] == '':
         cleaned_lines.pop()
     
-    return '\n'.join(cleaned_lines)
+    return cleaned_lines
 
-def enforce_correct_answer_format(text: str) -> str:
-    lines = text.split('\n')
-    formatted_lines = []
-    current_question_has_tick = False
-    
-    for line in lines:
-        line = line.strip()
-        if not line:
-            formatted_lines.append(line)
-            continue
-            
-        if re.match(r'^\d+\.', line):
-            current_question_has_tick = False
-            formatted_lines.append(line)
-            
-        elif re.match(r'^\([A-D]\)', line):
-            clean_line = re.sub(r'[✅✓✔️☑️🔴🟢⭐🎯]', '', line).strip()
+def clean_question_format(text: str) -> str:
+    return '\n'.join(_clean_question_lines(text))
+
+def _tick_line(line: str, has_tick: bool) -> tuple[str, bool]:
+    """Tick (D) once per question; returns the line and the updated flag. Expects a stripped line."""
+    if not line:
+        return line, has_tick
+        
+    kind = _line_kind(line)
+    if kind == 'q':
+        return line, False
+        
+    if kind == 'opt':
+        clean_line = line.translate(_TICK_TABLE).strip()
+        if not has_tick and line.startswith('(D)'):
+            return f"{clean_line} ✅", True
+        return clean_line, has_tick
             
-            if not current_question_has_tick and line.startswith('(D)'):
-                formatted_lines.append(f"{clean_line} ✅")
-                current_question_has_tick = True
-            else:
-                formatted_lines.append(clean_line)
-                
-        else:
-            formatted_lines.append(line)
-    
-    return '\n'.join(formatted_lines)
+    return line, has_tick
+
+def enforce_correct_answer_format(text: str) -> str:
+    return '\n'.join(_format_lines(text.split('\n'), ticks=True))
 
 def nuclear_tick_fix(text: str) -> str:
     """
     NUCLEAR OPTION: Force ✅ on option d) for every question
     """
     lines = text.split('\n')
-    fixed_lines = []
+    fixed_lines: list[str] = []
     
     for i, line in enumerate(lines):
         line = line.strip()
-        line = re.sub(r'[✅✓✔️☑️]', '', line).strip()
+        line = line.translate(_TICK_TABLE_BASIC).strip()
         
-        if re.match(r'^\(D\)', line):
+        if _RE_OPT_D.match(line):
             fixed_lines.append(f"{line} ✅")
         else:
             fixed_lines.append(line)
     
     return '\n'.join(fixed_lines)
 
+def _explanation_line(line: str) -> str:
+    line = line.replace('**', '')
+    return _RE_EXPLAIN_PREFIX.sub('Ex:', line, count=1)
+
 def enforce_explanation_format(text: str) -> str:
-    lines = text.split('\n')
-    cleaned_lines = []
-    
-    for line in lines:
-        line = line.replace('**', '')
-        
-        if any(marker in line for marker in ['વિગતઃ', 'Explanation:', 'Explain:', 'Details:']):
-            if line.startswith('વિગતઃ'):
-                line = line.replace('વિગતઃ', 'Ex:', 1)
-            elif line.startswith('Explanation:'):
-                line = line.replace('Explanation:', 'Ex:', 1)
-            elif line.startswith('Explain:'):
-                line = line.replace('Explain:', 'Ex:', 1)
-            elif line.startswith('Details:'):
-                line = line.replace('Details:', 'Ex:', 1)
+    return '\n'.join(_format_lines(text.split('\n'), explanations=True))
+
+def _limit_line(line: str) -> str:
+    """Apply Telegram's poll length limits. Expects a stripped line."""
+    # The tightest limit is 100 chars for a whole option line.
+    if len(line) <= 100:
+        return line
         
-        cleaned_lines.append(line)
-    
-    return '\n'.join(cleaned_lines)
+    kind = _line_kind(line)
+    if kind == 'q':
+        if len(line) > 4096:
+            return _truncate_words(line, 4096)
+        return line
+            
+    if kind == 'opt':
+        if len(line) > 100:
+            option_marker = line[:4]
+            option_text = line[4:].strip()
+            if len(option_text) > 96:
+                option_text = _truncate_words(option_text, 96)
+            return f"{option_marker}{option_text}"
+        return line
+            
+    if kind == 'ex':
+        explanation = line[3:].strip()
+        if len(explanation) > 200:
+            explanation = _leading_sentences(explanation, 200) or explanation[:200]
+            if not explanation.endswith(('.', '!', '?')):
+                explanation += '.'
+            return f"Ex: {explanation}"
+        return line
+            
+    return line
 
 def enforce_telegram_limits_strict(text: str) -> str:
-    lines = text.split('\n')
-    enforced_lines = []
-    
+    return '\n'.join(_format_lines(text.split('\n'), limits=True))
+
+def _format_lines(lines: Iterable[str], *, optimize: bool = False, explanations: bool = False,
+                  ticks: bool = False, limits: bool = False) -> list[str]:
+    """
+    One pass over the lines applying the selected per-line stages in the
+    order the handlers chain them: poll optimisation, explanation markers,
+    (D) ticks, Telegram limits. Same result as calling the public functions
+    back to back, without re-splitting and re-joining the text at each step.
+    The tick and limit stages both work on stripped lines and keep them
+    stripped, so the line is stripped once before the first of them.
+    """
+    out: list[str] = []
+    has_tick = False
+    strip = ticks or limits
     for line in lines:
-        line = line.strip()
-        if not line:
-            enforced_lines.append(line)
-            continue
-            
-        if re.match(r'^\d+\.', line):
-            if len(line) > 4096:
-                words = line.split()
-                shortened = []
-                current_length = 0
-                for word in words:
-                    if current_length + len(word) + 1 <= 4096:
-                        shortened.append(word)
-                        current_length += len(word) + 1
-                    else:
-                        break
-                enforced_lines.append(' '.join(shortened) if shortened else line[:4096])
-            else:
-                enforced_lines.append(line)
-                
-        elif re.match(r'^\([A-D]\)', line):
-            if len(line) > 100:
-                option_marker = line[:4]
-                option_text = line[4:].strip()
-                if len(option_text) > 96:
-                    words = option_text.split()
-                    important_words = []
-                    current_length = 0
-                    for word in words:
-                        if current_length + len(word) + 1 <= 96:
-                            important_words.append(word)
-                            current_length += len(word) + 1
-                        else:
-                            break
-                    option_text = ' '.join(important_words) if important_words else option_text[:96]
-                enforced_lines.append(f"{option_marker}{option_text}")
-            else:
-                enforced_lines.append(line)
-                
-        elif line.startswith('Ex:'):
-            explanation = line[3:].strip()
-            if len(explanation) > 200:
-                sentences = re.split(r'[.!?]', explanation)
-                important_parts = []
-                current_length = 0
-                for sentence in sentences:
-                    sentence = sentence.strip()
-                    if not sentence:
-                        continue
-                    sentence_with_dot = sentence + '.' if not sentence.endswith('.') else sentence
-                    if current_length + len(sentence_with_dot) <= 200:
-                        important_parts.append(sentence)
-                        current_length += len(sentence_with_dot)
-                    else:
-                        break
-                explanation = '. '.join(important_parts) if important_parts else explanation[:200]
-                if not explanation.endswith(('.', '!', '?')):
-                    explanation += '.'
-                enforced_lines.append(f"Ex: {explanation}")
-            else:
-                enforced_lines.append(line)
-                
-        else:
-            enforced_lines.append(line)
-    
-    return '\n'.join(enforced_lines)
\ No newline at end of file
+        if optimize:
+            line = _optimize_line(line)
+        if explanations:
+            line = _explanation_line(line)
+        if strip:
+            line = line.strip()
+        if ticks:
+            line, has_tick = _tick_line(line, has_tick)
+        if limits:
+            line = _limit_line(line)
+        out.append(line)
+    return out
+
+def format_for_telegram(text: str, optimize: bool = False, explanations: bool = False, ticks: bool = True) -> str:
+    """
+    clean_question_format followed by the selected cleanup stages and the
+    Telegram limits, fused into a single pass over the cleaned lines.
+    """
+    lines = _clean_question_lines(text)
+    return '\n'.join(_format_lines(lines, optimize=optimize, explanations=explanations, ticks=ticks, limits=True))
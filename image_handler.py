@@ -1,19 +1,45 @@
 # image_handler.py
-import os
-import tempfile
+import asyncio
+import functools
 import logging
+from collections import deque
 from pathlib import Path
+try:
+    from PIL import Image, ImageOps  # optional: downscale large photos before upload
+except ImportError:
+    Image = None
 from telegram import Update
 from telegram.ext import ContextTypes
 from telegram.constants import ChatAction
 
 from config import *
 from decorators import owner_only
-from helpers import safe_reply, stream_b64_encode, get_mime_type, clean_question_format, enforce_correct_answer_format
+from helpers import safe_reply, reply_text_file, stream_b64_encode_async, get_mime_type, clean_question_format, enforce_correct_answer_format, count_numbered, remove_files, download_to_temp
 from gemini_client import call_gemini_api
 
 logger = logging.getLogger(__name__)
 
+# Gemini works on images at a fixed internal resolution, so larger photos only
+# cost upload bytes, base64 work and input tokens.
+MAX_IMAGE_SIDE = 2048
+_SHRINK_FORMATS = {"JPEG", "PNG"}
+
+def shrink_image(image_path: str, max_side: int = MAX_IMAGE_SIDE) -> None:
+    """Downscale a JPEG/PNG in place so its longer side is at most max_side."""
+    if Image is None:
+        return
+    with Image.open(image_path) as img:
+        if img.format not in _SHRINK_FORMATS or max(img.size) <= max_side:
+            return
+        fmt = img.format
+        # Apply the EXIF rotation first; the re-encoded file drops the tag.
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        if fmt == "JPEG":
+            img.save(image_path, "JPEG", quality=85, optimize=True, progressive=True)
+        else:
+            img.save(image_path, "PNG", optimize=True)
+
 @owner_only
 async def image_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["awaiting_image"] = True
@@ -31,7 +57,7 @@ async def image_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @owner_only
 async def images_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["awaiting_images"] = True
-    context.user_data["collected_images"] = []
+    context.user_data["collected_images"] = deque(maxlen=MAX_IMAGES)
     await safe_reply(update,
         f"🖼️ Send me up to {MAX_IMAGES} images one by one (≤{MAX_IMAGE_SIZE_MB}MB each)\n\n"
         f"*Enhanced processing with Gemini 2.5 Pro*\n"
@@ -98,49 +124,42 @@ async def process_single_image(update: Update, context: ContextTypes.DEFAULT_TYP
                 f"📝 Generating Telegram-poll-ready questions..."
             )
         
-        data_b64 = stream_b64_encode(image_path)
+        data_b64 = await stream_b64_encode_async(image_path)
         mime_type = get_mime_type(image_path)
         
         payload = create_image_prompt(data_b64, mime_type, lang, is_mcq)
-        result = call_gemini_api(payload)
+        result = await call_gemini_api(payload)
         
         if not result:
             await safe_reply(update, "❌ Failed to process image.")
             return
         
         # Clean and format result
-        cleaned_result = clean_question_format(result)
+        # Cleanup runs in a worker thread, off the event loop
+        cleaned_result = await asyncio.to_thread(clean_question_format, result)
         
         # Count questions
-        question_count = len(re.findall(r'\d+\.', cleaned_result))
+        question_count = count_numbered(cleaned_result)
         
-        # Save and send results
+        # Send results
         file_type = "mcq" if is_mcq else "content"
-        with tempfile.NamedTemporaryFile(mode="w", encoding="utf-8",
-                                       suffix=f"_{file_type}_questions.txt", delete=False) as f:
-            f.write(cleaned_result)
-            txt_path = f.name
-        
         action = "extracted" if is_mcq else "generated"
-        await safe_reply(update, f"✅ Successfully {action} {question_count} Telegram-poll-ready questions from image", txt_path)
+        await reply_text_file(update, f"✅ Successfully {action} {question_count} Telegram-poll-ready questions from image",
+                              cleaned_result, f"{file_type}_questions.txt")
         
     except Exception as e:
         logger.error(f"Image processing error: {e}")
         await safe_reply(update, f"❌ Error: {str(e)}")
     finally:
-        # Cleanup
-        if 'image_path' in locals():
-            try:
-                os.unlink(image_path)
-                logger.info("Cleaned up input image")
-                context.user_data.pop("current_image", None)
-            except Exception as e:
-                logger.error(f"Error cleaning image: {e}")
+        # Cleanup, in the background
+        context.application.create_task(remove_files(image_path))
+        context.user_data.pop("current_image", None)
 
 async def process_multiple_images(update: Update, context: ContextTypes.DEFAULT_TYPE, is_mcq: bool = True):
     await update.message.reply_chat_action(ChatAction.TYPING)
     
-    images = context.user_data.get("collected_images", [])
+    # Claimed with one pop, so a repeated command cannot process them twice
+    images = context.user_data.pop("collected_images", None)
     if not images:
         await safe_reply(update, "❌ No images to process")
         return
@@ -161,61 +180,81 @@ async def process_multiple_images(update: Update, context: ContextTypes.DEFAULT_
                 f"📝 Generating Telegram-poll-ready questions..."
             )
         
-        # Process first image
-        image_path = images[0]
-        data_b64 = stream_b64_encode(image_path)
-        mime_type = get_mime_type(image_path)
+        # Two-stage pipeline: one encoder feeds payloads through a small bounded
+        # queue to MAX_CONCURRENT_IMAGES senders, so the next image is encoded
+        # while earlier ones are with Gemini, and at most workers + queue
+        # payloads are held in memory.
+        workers = min(len(images), MAX_CONCURRENT_IMAGES)
+        queue = asyncio.Queue(maxsize=2)
+        results = [None] * len(images)
         
-        payload = create_image_prompt(data_b64, mime_type, lang, is_mcq)
-        result = call_gemini_api(payload)
+        async def encode_all():
+            for i, image_path in enumerate(images):
+                try:
+                    data_b64 = await stream_b64_encode_async(image_path)
+                except Exception as e:
+                    logger.error(f"Image {image_path} could not be read: {e}")
+                    continue
+                await queue.put((i, create_image_prompt(data_b64, get_mime_type(image_path), lang, is_mcq)))
+            for _ in range(workers):
+                await queue.put(None)
         
-        if not result:
+        async def send_all():
+            while (item := await queue.get()) is not None:
+                i, payload = item
+                try:
+                    results[i] = await call_gemini_api(payload)
+                except Exception as e:
+                    logger.error(f"Image {images[i]} failed: {e}")
+        
+        await asyncio.gather(encode_all(), *(send_all() for _ in range(workers)))
+        texts = [result for result in results if result]
+        
+        if not texts:
             await safe_reply(update, "❌ Failed to generate questions from images")
             return
         
-        # Clean and format result
-        cleaned_result = clean_question_format(result)
+        # Clean and format the combined result, in image order
+        cleaned_result = await asyncio.to_thread(clean_question_format, "\n\n".join(texts))
         
         # Count questions
-        question_count = len(re.findall(r'\d+\.', cleaned_result))
+        question_count = count_numbered(cleaned_result)
         
-        # Save and send results
+        # Send results
         file_type = "mcq" if is_mcq else "content"
-        with tempfile.NamedTemporaryFile(mode="w", encoding="utf-8",
-                                       suffix=f"_{file_type}_questions.txt", delete=False) as f:
-            f.write(cleaned_result)
-            txt_path = f.name
-        
         action = "extracted" if is_mcq else "generated"
-        await safe_reply(update, f"✅ Successfully {action} {question_count} Telegram-poll-ready questions from {len(images)} images", txt_path)
+        await reply_text_file(update, f"✅ Successfully {action} {question_count} Telegram-poll-ready questions from {len(images)} images",
+                              cleaned_result, f"{file_type}_questions.txt")
         
     except Exception as e:
         logger.error(f"Multiple images processing error: {e}")
         await safe_reply(update, f"❌ Error: {str(e)}")
     finally:
-        # Cleanup all input images
-        for image_path in context.user_data.get("collected_images", []):
-            try:
-                os.unlink(image_path)
-            except Exception as e:
-                logger.error(f"Error cleaning image {image_path}: {e}")
+        # Cleanup all input images, in the background
+        context.application.create_task(remove_files(*images))
         
         context.user_data["awaiting_images"] = False
-        context.user_data["collected_images"] = []
-        logger.info("Cleaned up all input images")
 
 async def collect_image(update: Update, context: ContextTypes.DEFAULT_TYPE, msg):
-    images = context.user_data.get("collected_images", [])
+    # Bounded by MAX_IMAGES and appended to in place; never reassigned.
+    images = context.user_data.get("collected_images")
+    if images is None:
+        images = context.user_data["collected_images"] = deque(maxlen=MAX_IMAGES)
     
-    if len(images) >= MAX_IMAGES:
+    if len(images) == images.maxlen:
         await safe_reply(update, f"❌ Maximum {MAX_IMAGES} images reached. Send /done to process.")
         return
     
     try:
         image_path = await download_image(update, context, msg)
         if image_path:
+            # Re-checked after the download: a full deque would silently drop
+            # (and leak) the oldest image on append.
+            if len(images) == images.maxlen:
+                await remove_files(image_path)
+                await safe_reply(update, f"❌ Maximum {MAX_IMAGES} images reached. Send /done to process.")
+                return
             images.append(image_path)
-            context.user_data["collected_images"] = images
             await safe_reply(update, f"✅ Image {len(images)}/{MAX_IMAGES} received. Send more or /done")
     except Exception as e:
         logger.error(f"Image collection error: {e}")
@@ -247,12 +286,12 @@ async def download_image(update: Update, context: ContextTypes.DEFAULT_TYPE, msg
         else:
             return None
         
-        # Create temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp_file:
-            image_path = tmp_file.name
-        
         # Download the file
-        await file.download_to_drive(image_path)
+        image_path = await download_to_temp(file, ext)
+        try:
+            await asyncio.to_thread(shrink_image, image_path)
+        except Exception as e:
+            logger.warning(f"Image resize skipped: {e}")
         return image_path
         
     except Exception as e:
@@ -260,63 +299,68 @@ async def download_image(update: Update, context: ContextTypes.DEFAULT_TYPE, msg
         await safe_reply(update, f"❌ Error downloading image: {str(e)}")
         return None
 
-def create_image_prompt(data_b64: str, mime_type: str, explanation_language: str, is_mcq: bool = True):
-    if is_mcq:
-        prompt_text = f"""
-        Extract ALL questions from this image.
+IMAGE_MCQ_PROMPT = """
+Extract ALL questions from this image.
 
-        TELEGRAM POLL LIMITS:
-        • Question: 4096 chars max
-        • Explanation: 200 chars max  
-        • Options: ~100 chars each
+TELEGRAM POLL LIMITS:
+• Question: 4096 chars max
+• Explanation: 200 chars max  
+• Options: ~100 chars each
 
-        RULES:
-        1. Preserve exact text from image
-        2. Explanations under 200 chars in {explanation_language}
-        3. Convert 1., 2., 3. → 1), 2), 3)
-        4. Extract every question
+RULES:
+1. Preserve exact text from image
+2. Explanations under 200 chars in {language}
+3. Convert 1., 2., 3. → 1), 2), 3)
+4. Extract every question
 
-        FORMAT:
-        [Number]. [Question]
-        a) [Option A]
-        b) [Option B]
-        c) [Option C]
-        d) [Option D] ✅
-        Ex: [Short explanation in {explanation_language}]
+FORMAT:
+[Number]. [Question]
+a) [Option A]
+b) [Option B]
+c) [Option C]
+d) [Option D] ✅
+Ex: [Short explanation in {language}]
 
-        Ensure all content fits Telegram limits.
-        """
-    else:
-        question_count = 25
-        prompt_text = f"""
-        Create {question_count} questions from this image.
+Ensure all content fits Telegram limits.
+"""
 
-        TELEGRAM LIMITS:
-        • Question: 4096 chars
-        • Explanation: 200 chars
-        • Options: ~100 chars
+IMAGE_CONTENT_PROMPT = """
+Create {question_count} questions from this image.
 
-        Generate {question_count} questions with:
-        - Questions under 4096 characters
-        - Options under 100 characters
-        - Explanations under 200 characters in {explanation_language}
+TELEGRAM LIMITS:
+• Question: 4096 chars
+• Explanation: 200 chars
+• Options: ~100 chars
 
-        FORMAT:
-        [Number]. [Question]
-        a) [Option A] 
-        b) [Option B]
-        c) [Option C]
-        d) [Option D] ✅
-        Ex: [Brief explanation in {explanation_language}]
+Generate {question_count} questions with:
+- Questions under 4096 characters
+- Options under 100 characters
+- Explanations under 200 characters in {language}
 
-        Keep all content within Telegram poll limits.
-        """
-    
+FORMAT:
+[Number]. [Question]
+a) [Option A] 
+b) [Option B]
+c) [Option C]
+d) [Option D] ✅
+Ex: [Brief explanation in {language}]
+
+Keep all content within Telegram poll limits.
+"""
+
+@functools.lru_cache(maxsize=8)
+def image_prompt_text(explanation_language: str, is_mcq: bool = True) -> str:
+    # Only the language varies, so each finished prompt is built once and shared.
+    if is_mcq:
+        return IMAGE_MCQ_PROMPT.format(language=explanation_language)
+    return IMAGE_CONTENT_PROMPT.format(language=explanation_language, question_count=25)
+
+def create_image_prompt(data_b64: str, mime_type: str, explanation_language: str, is_mcq: bool = True):
     return {
         "contents": [{
             "parts": [
                 {"inlineData": {"mimeType": mime_type, "data": data_b64}},
-                {"text": prompt_text}
+                {"text": image_prompt_text(explanation_language, is_mcq)}
             ]
         }],
         "generationConfig": {
@@ -1,16 +1,22 @@
 # main_bot.py — FINAL UPDATED VERSION with /bi support
 
 import os
+import hmac
+import signal
+import asyncio
 import logging
-from flask import Flask, jsonify
+from urllib.parse import urlsplit
+from flask import Flask, jsonify, request
 import waitress
 from threading import Thread
+from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     filters,
 )
+from telegram.request import HTTPXRequest
 
 # Import configurations
 from config import *
@@ -22,6 +28,8 @@ from pdf_handler import pdf_process, mcq_command, content_command, websankul_pro
 from image_handler import image_process, images_process, done_images
 from ai_handler import ai_command
 from file_handler import handle_file
+from gemini_client import aclose as close_gemini_client
+from helpers import close_download_client
 
 # ✅ NEW IMPORT FOR BI HANDLER
 from bi_handler import bi_command, bi_file_handler
@@ -44,57 +52,120 @@ def home():
 def health():
     return jsonify({"status": "healthy"})
 
+def run_flask():
+    logger.info(f"🌐 Starting Flask server on port {PORT}")
+    waitress.serve(flask_app, host="0.0.0.0", port=PORT)
+
+def run_webhook(application):
+    """
+    Webhook mode. Updates are POSTed to the Flask app, which keeps serving the
+    health routes on the same port; they are handed to the bot's event loop.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    @flask_app.post(urlsplit(WEBHOOK_URL).path or "/")
+    def telegram_webhook():
+        # Only Telegram knows the secret passed to set_webhook; anything else
+        # could forge an update from the owner's user id.
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return "", 403
+        update = Update.de_json(request.get_json(force=True), application.bot)
+        asyncio.run_coroutine_threadsafe(application.update_queue.put(update), loop)
+        return "", 200
+
+    async def serve():
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        await application.initialize()
+        await application.bot.set_webhook(
+            WEBHOOK_URL,
+            drop_pending_updates=True,
+            allowed_updates=["message", "callback_query"],
+            secret_token=WEBHOOK_SECRET,
+        )
+        await application.start()
+        Thread(target=run_flask, daemon=True).start()
+        try:
+            await stop.wait()
+        finally:
+            await application.stop()
+            await application.shutdown()
+            await close_clients(application)
+
+    loop.run_until_complete(serve())
+
+async def close_clients(application):
+    """post_shutdown: close the shared Gemini and Telegram-download clients."""
+    await close_gemini_client()
+    await close_download_client()
+
+# (command, callback), registered in this order.
+COMMAND_HANDLERS = (
+    ("start", start),
+    ("setlang", setlang),
+    ("setcount", setcount),
+    ("status", status),
+
+    ("pdf", pdf_process),
+    ("websankul", websankul_process),
+    ("image", image_process),
+    ("images", images_process),
+    ("done", done_images),
+
+    ("mcq", mcq_command),
+    ("content", content_command),
+    ("websankul_process", websankul_command),
+
+    ("ai", ai_command),
+
+    # ✅ NEW BI COMMAND SUPPORT
+    ("bi", bi_command),
+)
+
 def run_bot():
 
-    # Initialize Telegram bot
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Initialize Telegram bot with one pooled client for Bot API calls;
+    # getUpdates gets its own so polling never waits behind a send.
+    application = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .request(HTTPXRequest(connection_pool_size=64, connect_timeout=10, read_timeout=60))
+        .get_updates_request(HTTPXRequest(connect_timeout=10, read_timeout=60))
+        .post_shutdown(close_clients)
+        .build()
+    )
 
     # -------------------------
     # COMMAND HANDLERS
     # -------------------------
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("setlang", setlang))
-    application.add_handler(CommandHandler("setcount", setcount))
-    application.add_handler(CommandHandler("status", status))
-
-    application.add_handler(CommandHandler("pdf", pdf_process))
-    application.add_handler(CommandHandler("websankul", websankul_process))
-    application.add_handler(CommandHandler("image", image_process))
-    application.add_handler(CommandHandler("images", images_process))
-    application.add_handler(CommandHandler("done", done_images))
-
-    application.add_handler(CommandHandler("mcq", mcq_command))
-    application.add_handler(CommandHandler("content", content_command))
-    application.add_handler(CommandHandler("websankul_process", websankul_command))
-
-    application.add_handler(CommandHandler("ai", ai_command))
-
-    # ✅ NEW BI COMMAND SUPPORT
-    application.add_handler(CommandHandler("bi", bi_command))
+    application.add_handlers([CommandHandler(name, callback) for name, callback in COMMAND_HANDLERS])
 
     # -------------------------
     # FILE HANDLER PRIORITY FIX
     # -------------------------
 
-    # ⚠️ TXT ONLY → must go BEFORE global handler,
-    # otherwise /bi never receives files
-    application.add_handler(MessageHandler(
-        filters.Document.FileExtension("txt"), bi_file_handler
-    ))
+    application.add_handlers([
+        # ⚠️ TXT ONLY → must go BEFORE global handler,
+        # otherwise /bi never receives files
+        MessageHandler(filters.Document.FileExtension("txt"), bi_file_handler),
 
-    # 🔥 GLOBAL FILE HANDLER (KEEP LAST!)
-    application.add_handler(MessageHandler(
-        filters.Document.ALL | filters.PHOTO,
-        handle_file
-    ))
+        # 🔥 GLOBAL FILE HANDLER (KEEP LAST!)
+        MessageHandler(filters.Document.ALL | filters.PHOTO, handle_file),
+    ])
 
     logger.info("🚀 Starting OCR + AI Bot with /bi support…")
 
-    # Flask thread
-    def run_flask():
-        logger.info(f"🌐 Starting Flask server on port {PORT}")
-        waitress.serve(flask_app, host="0.0.0.0", port=PORT)
+    if WEBHOOK_URL:
+        # No getUpdates loop; health checks keep using the token-free / and /health.
+        logger.info("🤖 Starting Telegram bot webhook…")
+        run_webhook(application)
+        return
 
+    # Flask thread
     flask_thread = Thread(target=run_flask, daemon=True)
     flask_thread.start()
 
@@ -1,23 +1,58 @@
 # pdf_handler.py
 import os
+import asyncio
+import functools
 import re
-import tempfile
 import logging
 from pathlib import Path
+from typing import Optional
 from telegram import Update
 from telegram.ext import ContextTypes
 from telegram.constants import ChatAction
 
 from config import *
 from decorators import owner_only
-from helpers import safe_reply, stream_b64_encode, clean_question_format, enforce_correct_answer_format, enforce_explanation_format, enforce_telegram_limits_strict
-from gemini_client import call_gemini_api
+from helpers import safe_reply, reply_text_file, stream_b64_encode_async, clean_question_format, enforce_explanation_format, format_for_telegram, count_numbered, remove_files, pdf_cache_lookup, cache_set_async
+from gemini_client import call_gemini_api, upload_file, delete_file, warm_connection
 
 logger = logging.getLogger(__name__)
 
+# "N." at the start of a line: one per question in the merged WebSankul output.
+_QUESTION_START = re.compile(r'^\d+\.', re.MULTILINE)
+
+# Batch 1 asks for 15 questions; fewer than this means the PDF was not read
+# properly, so batch 1 is retried once and, if still short, batch 2 is dropped.
+WEBSANKUL_MIN_QUESTIONS = 10
+
+def count_questions(text: Optional[str]) -> int:
+    return sum(1 for _ in _QUESTION_START.finditer(text)) if text else 0
+
+# Status messages sent when processing starts; only the size varies.
+PDF_STATUS = "🔄 Processing {kind} PDF ({size})..."
+WEBSANKUL_STATUS = (
+    "🎯 Processing WebSankul PDF ({size})\n"
+    "⏰ Estimated time: 4-8 minutes\n"
+    "🔍 Batch 1: Extracting questions 1-15...\n"
+    "🔍 Batch 2: Extracting questions 16-30..."
+)
+
+def format_size(size: int) -> str:
+    """Whole MB, or whole KB under 1MB (instead of "0.0MB" for small files)."""
+    return f"{size >> 20}MB" if size >= 1 << 20 else f"{size >> 10}KB"
+
+async def send_status(update: Update, text: str):
+    """Runs as a background task; a failed status must not fail the finished job."""
+    try:
+        await update.message.reply_chat_action(ChatAction.TYPING)
+        await safe_reply(update, text)
+    except Exception as e:
+        logger.warning(f"Status message failed: {e}")
+
 @owner_only
 async def pdf_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["awaiting_pdf"] = True
+    # Connect to Gemini now, while the user picks and sends the PDF
+    context.application.create_task(warm_connection())
     await safe_reply(update, 
         f"📄 Send me a PDF file (≤{MAX_PDF_SIZE_MB}MB)\n\n"
         f"After sending, choose:\n"
@@ -28,6 +63,7 @@ async def pdf_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @owner_only
 async def websankul_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["awaiting_websankul"] = True
+    context.application.create_task(warm_connection())
     await safe_reply(update, 
         "🎯 WebSankul Mode Activated\n\n"
         "📄 Send me a WebSankul PDF with:\n"
@@ -39,48 +75,138 @@ async def websankul_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @owner_only
 async def mcq_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data.get("current_file"):
-        file_path = context.user_data["current_file"]
-        await process_pdf(update, context, file_path, is_mcq=True)
+    # Claimed with one pop (no await in between), so a repeated command
+    # while this one runs finds no file instead of processing it twice.
+    file_path = context.user_data.pop("current_file", None)
+    file_size = context.user_data.pop("current_file_size", None)
+    file_id = context.user_data.pop("current_file_id", None)
+    if file_path:
+        await process_pdf(update, context, file_path, is_mcq=True, file_size=file_size, file_id=file_id)
     else:
         await safe_reply(update, "❌ No PDF found. Please send a PDF first using /pdf")
 
 @owner_only
 async def content_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data.get("current_file"):
-        file_path = context.user_data["current_file"]
-        await process_pdf(update, context, file_path, is_mcq=False)
+    # Claimed with one pop (no await in between), so a repeated command
+    # while this one runs finds no file instead of processing it twice.
+    file_path = context.user_data.pop("current_file", None)
+    file_size = context.user_data.pop("current_file_size", None)
+    file_id = context.user_data.pop("current_file_id", None)
+    if file_path:
+        await process_pdf(update, context, file_path, is_mcq=False, file_size=file_size, file_id=file_id)
     else:
         await safe_reply(update, "❌ No PDF found. Please send a PDF first using /pdf")
 
 @owner_only
 async def websankul_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data.get("current_file"):
-        file_path = context.user_data["current_file"]
-        await process_websankul_pdf(update, context, file_path)
+    # Claimed with one pop (no await in between), so a repeated command
+    # while this one runs finds no file instead of processing it twice.
+    file_path = context.user_data.pop("current_file", None)
+    file_size = context.user_data.pop("current_file_size", None)
+    file_id = context.user_data.pop("current_file_id", None)
+    if file_path:
+        await process_websankul_pdf(update, context, file_path, file_size, file_id)
     else:
         await safe_reply(update, "❌ No PDF found. Please send a PDF first using /websankul")
 
-def create_pdf_prompt(data_b64: str, explanation_language: str, is_mcq: bool = True):
+async def pdf_part(file_path: str, size: int):
+    """
+    The PDF as a request part: a Files API reference when the upload works,
+    else base64 inlineData as before. Also returns the uploaded file's name
+    for delete_file (None when inline).
+    """
+    try:
+        file = await upload_file(file_path, "application/pdf", size)
+        return {"fileData": {"mimeType": "application/pdf", "fileUri": file["uri"]}}, file["name"]
+    except Exception as e:
+        logger.warning(f"Files API upload failed, sending PDF inline: {e}")
+        data_b64 = await stream_b64_encode_async(file_path)
+        return {"inlineData": {"mimeType": "application/pdf", "data": data_b64}}, None
+
+PDF_MCQ_PROMPT = """
+Extract ALL multiple-choice questions from this PDF.
+Find answers from marks/highlights/answer keys.
+Format for Telegram polls with explanations in {language}.
+Ensure ALL content fits Telegram limits.
+"""
+
+PDF_CONTENT_PROMPT = """
+Create {question_count} educational questions from this PDF.
+Format for Telegram polls with explanations in {language}.
+Ensure ALL content fits Telegram limits.
+"""
+
+WEBSANKUL_PROMPT = """
+PROCESS THIS WEBSANKUL PDF:
+
+✅ PDF STRUCTURE:
+- First: 30 Questions (no answers)
+- Middle: OMR page  
+- Second: SAME 30 Questions with RED ANSWERS
+
+✅ PROCESS QUESTIONS: {batch_range}
+- Find SECOND occurrence of questions {batch_range}
+- Identify RED option = CORRECT answer
+- Generate brief explanations
+- ENFORCE Telegram poll limits
+
+✅ TELEGRAM LIMITS:
+• Questions: ≤4096 chars
+• Options: ≤100 chars each
+• Explanations: ≤200 chars
+
+✅ PERFECT FORMAT:
+1. [Question]
+(A) [Option A]
+(B) [Option B]
+(C) [Option C]
+(D) [Option D] ✅
+Ex: [Brief explanation]
+
+[ONE BLANK LINE]
+
+2. [Next Question]
+(A) [Option A]
+(B) [Option B]
+(C) [Option C]
+(D) [Option D] ✅
+Ex: [Brief explanation]
+
+[ONE BLANK LINE]
+
+✅ HANDLE STATEMENT QUESTIONS:
+If question has statements (I. II. III. etc.), format like:
+1. Consider the following statements:
+I. [Statement 1]
+II. [Statement 2] 
+III. [Statement 3]
+Which of the above is correct?
+(A) Only I and II
+(B) Only II and III
+(C) Only I and III
+(D) All I, II and III ✅
+Ex: [Brief explanation]
+
+✅ OUTPUT ONLY QUESTIONS {batch_range} WITH PERFECT FORMATTING!
+"""
+
+@functools.lru_cache(maxsize=8)
+def pdf_prompt_text(explanation_language: str, is_mcq: bool = True) -> str:
+    # Only the language varies, so each finished prompt is built once and shared.
     if is_mcq:
-        prompt_text = f"""
-        Extract ALL multiple-choice questions from this PDF.
-        Find answers from marks/highlights/answer keys.
-        Format for Telegram polls with explanations in {explanation_language}.
-        Ensure ALL content fits Telegram limits.
-        """
-    else:
-        prompt_text = f"""
-        Create 30 educational questions from this PDF.
-        Format for Telegram polls with explanations in {explanation_language}.
-        Ensure ALL content fits Telegram limits.
-        """
-    
+        return PDF_MCQ_PROMPT.format(language=explanation_language)
+    return PDF_CONTENT_PROMPT.format(language=explanation_language, question_count=30)
+
+@functools.lru_cache(maxsize=8)
+def websankul_prompt_text(batch_range: str) -> str:
+    return WEBSANKUL_PROMPT.format(batch_range=batch_range)
+
+def create_pdf_prompt(pdf: dict, explanation_language: str, is_mcq: bool = True):
     return {
         "contents": [{
             "parts": [
-                {"inlineData": {"mimeType": "application/pdf", "data": data_b64}},
-                {"text": prompt_text}
+                pdf,
+                {"text": pdf_prompt_text(explanation_language, is_mcq)}
             ]
         }],
         "generationConfig": {
@@ -89,66 +215,12 @@ def create_pdf_prompt(data_b64: str, explanation_language: str, is_mcq: bool = T
         }
     }
 
-def create_websankul_prompt(data_b64: str, explanation_language: str, batch_range: str = "1-30"):
-    prompt_text = f"""
-    PROCESS THIS WEBSANKUL PDF:
-
-    ✅ PDF STRUCTURE:
-    - First: 30 Questions (no answers)
-    - Middle: OMR page  
-    - Second: SAME 30 Questions with RED ANSWERS
-
-    ✅ PROCESS QUESTIONS: {batch_range}
-    - Find SECOND occurrence of questions {batch_range}
-    - Identify RED option = CORRECT answer
-    - Generate brief explanations
-    - ENFORCE Telegram poll limits
-
-    ✅ TELEGRAM LIMITS:
-    • Questions: ≤4096 chars
-    • Options: ≤100 chars each
-    • Explanations: ≤200 chars
-
-    ✅ PERFECT FORMAT:
-    1. [Question]
-    (A) [Option A]
-    (B) [Option B]
-    (C) [Option C]
-    (D) [Option D] ✅
-    Ex: [Brief explanation]
-
-    [ONE BLANK LINE]
-
-    2. [Next Question]
-    (A) [Option A]
-    (B) [Option B]
-    (C) [Option C]
-    (D) [Option D] ✅
-    Ex: [Brief explanation]
-
-    [ONE BLANK LINE]
-
-    ✅ HANDLE STATEMENT QUESTIONS:
-    If question has statements (I. II. III. etc.), format like:
-    1. Consider the following statements:
-    I. [Statement 1]
-    II. [Statement 2] 
-    III. [Statement 3]
-    Which of the above is correct?
-    (A) Only I and II
-    (B) Only II and III
-    (C) Only I and III
-    (D) All I, II and III ✅
-    Ex: [Brief explanation]
-
-    ✅ OUTPUT ONLY QUESTIONS {batch_range} WITH PERFECT FORMATTING!
-    """
-    
+def create_websankul_prompt(pdf: dict, explanation_language: str, batch_range: str = "1-30"):
     return {
         "contents": [{
             "parts": [
-                {"inlineData": {"mimeType": "application/pdf", "data": data_b64}},
-                {"text": prompt_text}
+                pdf,
+                {"text": websankul_prompt_text(batch_range)}
             ]
         }],
         "generationConfig": {
@@ -157,134 +229,175 @@ def create_websankul_prompt(data_b64: str, explanation_language: str, batch_rang
         }
     }
 
-async def process_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE, file_path: str, is_mcq: bool = True):
-    await update.message.reply_chat_action(ChatAction.TYPING)
-    
+async def process_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE, file_path: str, is_mcq: bool = True,
+                      file_size: Optional[int] = None, file_id: Optional[str] = None):
+    status = None
     try:
         lang = context.user_data.get("language", "gujarati")
-        file_size = os.path.getsize(file_path) / (1024 * 1024)
+        if file_size is None:
+            file_size = await asyncio.to_thread(os.path.getsize, file_path)
         
-        if is_mcq:
-            await safe_reply(update, f"🔄 Processing MCQ PDF ({file_size:.1f}MB)...")
-        else:
-            await safe_reply(update, f"🔄 Processing content PDF ({file_size:.1f}MB)...")
-        
-        data_b64 = stream_b64_encode(file_path)
-        payload = create_pdf_prompt(data_b64, lang, is_mcq)
-        result = call_gemini_api(payload)
+        # Sent in the background: the cache lookup and upload start without
+        # waiting on Telegram, and the result is only sent after the status.
+        status = context.application.create_task(send_status(update, PDF_STATUS.format(
+            kind="MCQ" if is_mcq else "content", size=format_size(file_size))))
         
-        if not result:
-            await safe_reply(update, "❌ Failed to process PDF.")
-            return
+        file_type = "mcq" if is_mcq else "content"
+        cleaned_result, cache_keys = await pdf_cache_lookup(file_path, file_id, file_type, lang)
         
-        cleaned_result = clean_question_format(result)
-        cleaned_result = enforce_correct_answer_format(cleaned_result)
-        cleaned_result = enforce_telegram_limits_strict(cleaned_result)
+        if cleaned_result is None:
+            pdf, uploaded = await pdf_part(file_path, file_size)
+            try:
+                payload = create_pdf_prompt(pdf, lang, is_mcq)
+                result = await call_gemini_api(payload)
+            finally:
+                if uploaded:
+                    context.application.create_task(delete_file(uploaded))
+            
+            if not result:
+                await status
+                await safe_reply(update, "❌ Failed to process PDF.")
+                return
+            
+            # Cleanup of a multi-hundred-KB reply runs in a worker thread, off the event loop
+            cleaned_result = await asyncio.to_thread(format_for_telegram, result)
+            await cache_set_async(cache_keys, cleaned_result)
+        else:
+            logger.info(f"Cache hit for {file_type} PDF ({lang})")
         
-        question_count = len(re.findall(r'\d+\.', cleaned_result))
-        
-        file_type = "mcq" if is_mcq else "content"
-        with tempfile.NamedTemporaryFile(mode="w", encoding="utf-8", 
-                                       suffix=f"_{file_type}_questions.txt", delete=False) as f:
-            f.write(cleaned_result)
-            txt_path = f.name
+        question_count = count_numbered(cleaned_result)
         
         action = "extracted" if is_mcq else "generated"
-        await safe_reply(update, f"✅ Successfully {action} {question_count} questions", txt_path)
+        await status
+        await reply_text_file(update, f"✅ Successfully {action} {question_count} questions", cleaned_result, f"{file_type}_questions.txt")
         
     except Exception as e:
         logger.error(f"PDF processing error: {e}")
+        if status is not None:
+            await status
         await safe_reply(update, f"❌ Error: {str(e)}")
     finally:
-        if 'file_path' in locals():
-            try:
-                os.unlink(file_path)
-                context.user_data.pop("current_file", None)
-            except Exception as e:
-                logger.error(f"Error cleaning PDF: {e}")
-
-async def process_websankul_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE, file_path: str):
-    await update.message.reply_chat_action(ChatAction.TYPING)
-    
+        if status is not None and not status.done():
+            status.cancel()
+        # Input cleanup runs in the background; the PDF was already claimed with a pop
+        context.application.create_task(remove_files(file_path))
+
+async def websankul_batch(pdf: dict, lang: str, batch_range: str, batch_name: str) -> Optional[str]:
+    """One WebSankul batch, cleaned for Telegram, or None (logged) if it failed."""
+    try:
+        result = await call_gemini_api(create_websankul_prompt(pdf, lang, batch_range))
+    except Exception as e:
+        logger.error(f"WebSankul {batch_name} - Gemini error: {e}")
+        return None
+    if not result:
+        logger.error(f"WebSankul {batch_name} - No result from Gemini API")
+        return None
+    logger.debug("WebSankul %s - Raw response length: %d characters", batch_name, len(result))
+    return await asyncio.to_thread(format_for_telegram, result, explanations=True, ticks=False)
+
+async def process_websankul_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE, file_path: str,
+                                file_size: Optional[int] = None, file_id: Optional[str] = None):
+    status = None
     try:
         lang = context.user_data.get("language", "gujarati")
-        file_size = os.path.getsize(file_path) / (1024 * 1024)
+        if file_size is None:
+            file_size = await asyncio.to_thread(os.path.getsize, file_path)
         
-        await safe_reply(update, 
-            f"🎯 Processing WebSankul PDF ({file_size:.1f}MB)\n"
-            f"⏰ Estimated time: 4-8 minutes\n"
-            f"🔍 Batch 1: Extracting questions 1-15...\n"
-            f"🔍 Batch 2: Extracting questions 16-30..."
-        )
+        status = context.application.create_task(send_status(update, WEBSANKUL_STATUS.format(size=format_size(file_size))))
         
-        data_b64 = stream_b64_encode(file_path)
-        all_questions = []
-        
-        # Process in 2 batches to get all 30 questions
-        batches = [
-            ("1-15", "Batch 1: Questions 1-15"),
-            ("16-30", "Batch 2: Questions 16-30")
-        ]
-        
-        for batch_range, batch_name in batches:
-            await safe_reply(update, f"🔄 Processing {batch_name}...")
+        final_result, cache_keys = await pdf_cache_lookup(file_path, file_id, "websankul", lang)
+        if final_result is not None:
+            logger.info(f"Cache hit for WebSankul PDF ({lang})")
+        else:
+            # Uploaded (or encoded) once and shared by both batches
+            pdf, uploaded = await pdf_part(file_path, file_size)
+            all_questions = []
+            failed = False
             
-            payload = create_websankul_prompt(data_b64, lang, batch_range)
-            result = call_gemini_api(payload)
+            # Process in 2 batches to get all 30 questions
+            batches = [
+                ("1-15", "Batch 1: Questions 1-15"),
+                ("16-30", "Batch 2: Questions 16-30")
+            ]
+            (first_range, first_name), (second_range, second_name) = batches
             
-            if result:
-                logger.info(f"WebSankul {batch_name} - Raw response length: {len(result)} characters")
-                
-                # Clean and format result
-                cleaned_result = clean_question_format(result)
-                cleaned_result = enforce_explanation_format(cleaned_result)
-                cleaned_result = enforce_telegram_limits_strict(cleaned_result)
-                
-                # Add to all questions
-                all_questions.append(cleaned_result)
-                
-                # Add separator between batches
-                if batch_range == "1-15":
-                    all_questions.append("\n" + "="*50 + "\n")
-            else:
-                logger.error(f"WebSankul {batch_name} - No result from Gemini API")
-                await safe_reply(update, f"❌ Failed to process {batch_name}. Continuing with available questions...")
-        
-        if not all_questions:
-            await safe_reply(update, "❌ Failed to process WebSankul PDF.")
-            return
-        
-        # Combine all questions
-        final_result = "\n".join(all_questions)
-        
-        # Final cleanup
-        final_result = clean_question_format(final_result)
-        final_result = enforce_explanation_format(final_result)
-        
-        question_count = len(re.findall(r'^\d+\.', final_result))
+            # The batches are independent, so both Gemini calls run at once. If batch 1
+            # stays short, batch 2 is kept only when it has already finished.
+            second = context.application.create_task(websankul_batch(pdf, lang, second_range, second_name))
+            try:
+                first_result = await websankul_batch(pdf, lang, first_range, first_name)
+                if count_questions(first_result) < WEBSANKUL_MIN_QUESTIONS:
+                    await safe_reply(update, f"🔁 {first_name} came back incomplete, retrying it...")
+                    retry = await websankul_batch(pdf, lang, first_range, first_name)
+                    if count_questions(retry) > count_questions(first_result):
+                        first_result = retry
+                # Batch 2 is awaited when batch 1 looks fine, or used as-is when it
+                # is already done; it is only dropped while it is still running.
+                skipped = count_questions(first_result) < WEBSANKUL_MIN_QUESTIONS and not second.done()
+                if skipped:
+                    second.cancel()
+                    second_result = None
+                else:
+                    second_result = await second
+            finally:
+                if not second.done():
+                    second.cancel()
+                if uploaded:
+                    context.application.create_task(delete_file(uploaded))
+            
+            for (batch_range, batch_name), cleaned_result in zip(batches, (first_result, second_result)):
+                if cleaned_result:
+                    # Add to all questions
+                    all_questions.append(cleaned_result)
+                    
+                    # Add separator between batches
+                    if batch_range == "1-15":
+                        all_questions.append("\n" + "="*50 + "\n")
+                elif skipped and batch_range == second_range:
+                    failed = True
+                    await safe_reply(update, f"⏭️ Skipped {batch_name}: {first_name} could not be read reliably.")
+                else:
+                    failed = True
+                    await safe_reply(update, f"❌ Failed to process {batch_name}. Continuing with available questions...")
+            
+            if not all_questions:
+                await status
+                await safe_reply(update, "❌ Failed to process WebSankul PDF.")
+                return
+            
+            # Combine all questions
+            final_result = "\n".join(all_questions)
+            
+            # Final cleanup regroups questions across the batch boundary, then
+            # normalises explanations again: the per-batch pass runs before the
+            # limits stage strips "**", so "** Explanation:" is only an explanation
+            # marker by now.
+            final_result = await asyncio.to_thread(clean_question_format, final_result)
+            final_result = await asyncio.to_thread(enforce_explanation_format, final_result)
+            # A partial result is sent but not cached, so the next upload retries the failed batch
+            if not failed:
+                await cache_set_async(cache_keys, final_result)
         
-        with tempfile.NamedTemporaryFile(mode="w", encoding="utf-8", 
-                                       suffix="_websankul_questions.txt", delete=False) as f:
-            f.write(final_result)
-            txt_path = f.name
+        question_count = count_questions(final_result)
         
-        await safe_reply(update, 
+        await status
+        await reply_text_file(update, 
             f"✅ WebSankul Processing Complete!\n"
             f"📊 Total Questions: {question_count}/30\n"
             f"🎯 Red Answers: Detected\n"
             f"🤖 Explanations: Generated\n"
             f"📝 Format: Telegram Poll Ready", 
-            txt_path
+            final_result,
+            "websankul_questions.txt"
         )
         
     except Exception as e:
         logger.error(f"WebSankul processing error: {e}")
+        if status is not None:
+            await status
         await safe_reply(update, f"❌ WebSankul Error: {str(e)}")
     finally:
-        if 'file_path' in locals():
-            try:
-                os.unlink(file_path)
-                context.user_data.pop("current_file", None)
-                context.user_data.pop("awaiting_websankul", None)
-            except Exception as e:
-                logger.error(f"Error cleaning WebSankul PDF: {e}")
\ No newline at end of file
+        if status is not None and not status.done():
+            status.cancel()
+        context.application.create_task(remove_files(file_path))
+        context.user_data.pop("awaiting_websankul", None)
\ No newline at end of file